@@ -0,0 +1,106 @@
+import ctypes
+
+import numpy
+
+from cage import Thing, StaticLines, DynamicThing, Living
+
+__author__ = 'AH'
+
+#Worlds many screens wide. TiledArena lays out `tiles` tiles of `tile` meters side by side: a bumpy floor
+#and a few platforms per tile, each tile one StaticLines on a static body, walls at both ends. ActiveRegion
+#keeps only the tiles within `reach` tiles of a living simulated: the dynamic things anywhere else are put
+#to sleep, and chipmunk neither integrates nor collides sleeping bodies. Things resting in active tiles fall
+#asleep on their own after sleep_time seconds, as do heaps of touching things anywhere. A living running
+#into sleeping things wakes them, sensor rays see them either way. Physics then costs what moves around the
+#livings, not what lies in the world.
+#
+#   arena = TiledArena(cage_env, 50, rng = cage_env.random)
+#   ActiveRegion(cage_env, arena, reach = 1)
+#   food_pool.spawn(arena.randomPoint(cage_env.random, 3.))
+
+class TiledArena(object):
+    def __init__(self, env, tiles, tile = 40., rng = None, floor = -5., bumps = 1.5, wall = 16.,
+                 color = (0.7,0.0,0.), platform_color = (0,1.0,0.0)):
+        if rng == None: rng = numpy.random
+        self.tiles, self.tile = tiles, float(tile)
+        self.left = -tiles * self.tile / 2.
+        self.right = -self.left
+        points = 8                                                  #Floor points per tile
+        self.floor_x = numpy.linspace(self.left, self.right, tiles * points + 1)
+        self.floor_y = numpy.clip(floor + numpy.cumsum(rng.uniform(-0.5, 0.5, len(self.floor_x))) * bumps * 0.5,
+                                  floor - bumps, floor + bumps)
+        self.chunks = []                                            #[StaticLines] of every tile
+        for k in range(tiles):
+            xs, ys = self.floor_x[k*points:(k+1)*points+1], self.floor_y[k*points:(k+1)*points+1]
+            chunk = [StaticLines(env, zip(xs, ys), 0.25, color, static = True)]
+            for p in range(rng.randint(0, 3)):
+                x = self.left + (k + rng.uniform(0.1, 0.8)) * self.tile
+                length, y = rng.uniform(3., 8.), self.floorAt(x) + rng.uniform(3., 6.)
+                chunk.append(StaticLines(env, [(x, y), (x + length, y + rng.uniform(-0.5, 0.5))], 0.1, platform_color, static = True))
+            self.chunks.append(chunk)
+        self.walls = [StaticLines(env, [(x, self.floorAt(x) + wall), (x, self.floorAt(x))], 0.25, color, static = True)
+                      for x in (self.left, self.right)]
+
+    def tileOf(self, x):
+        return min(max(int((x - self.left) // self.tile), 0), self.tiles - 1)
+    def tileSpan(self, k):
+        return self.left + k * self.tile, self.left + (k+1) * self.tile
+    def floorAt(self, x):
+        return numpy.interp(x, self.floor_x, self.floor_y)
+    def randomPoint(self, rng, above = 2., margin = 1.):
+        #Somewhere above the floor, in any tile
+        x = rng.uniform(self.left + margin, self.right - margin)
+        return x, self.floorAt(x) + above
+
+def touches_dynamic(body):
+    #Whether the last step left body in contact with a body that is not static. Chipmunk puts touching bodies
+    #to sleep together, one of them forced asleep alone leaves its contact graph dangling (and aborts)
+    c = body._body.contents
+    address = ctypes.addressof(c)
+    arb = c.arbiterList_private
+    while arb:
+        a = arb.contents
+        first = ctypes.addressof(a.body_a_private.contents) == address
+        other = (a.body_b_private if first else a.body_a_private).contents
+        if other.node_private.idleTime != float('inf'): return True
+        arb = (a.thread_a_private if first else a.thread_b_private).next
+    return False
+
+class ActiveRegion(Thing):
+    #A thing in the environment, so its update runs every time step before physics, when bodies may sleep
+    passive = False
+    def __init__(self, env, arena, reach = 1, sleep_time = 0.5, sweep_every = 30):
+        self.arena = arena
+        self.reach = reach                                          #Tiles to either side of a living
+        self.sweep_every = sweep_every                              #Steps between puttings to sleep of strays
+        self.active = set()
+        env.space.sleep_time_threshold = sleep_time
+        Thing.__init__(self, env)
+
+    def tilesAround(self, env):
+        tiles = set()
+        for living in env.things.ofType(Living):
+            k = self.arena.tileOf(living.position[0])
+            tiles.update(range(max(k - self.reach, 0), min(k + self.reach, self.arena.tiles - 1) + 1))
+        return tiles
+    def updateState(self, env, dt):
+        tiles = self.tilesAround(env)
+        if tiles != self.active or env.steps % self.sweep_every == 0: self._sweep(env, tiles, tiles - self.active)
+        self.active = tiles
+    def _sweep(self, env, tiles, woken):
+        #Things in tiles that just became active wake up, awake things outside the active tiles go to sleep
+        tileOf = self.arena.tileOf
+        for th in env.things.ofType(DynamicThing):
+            if isinstance(th, Living): continue
+            body = th.body
+            k = tileOf(body.position.x)
+            if k in tiles:
+                if k in woken and body.is_sleeping: body.activate()
+            elif not body.is_sleeping and not touches_dynamic(body): body.sleep()     #Else chipmunk or a later sweep
+
+    def sleeping(self, env):
+        return sum(1 for th in env.things.ofType(DynamicThing) if th.body.is_sleeping)
+    def draw(self, env):
+        return None
+    def removeFromEnv(self, env):
+        return None
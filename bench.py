@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import time
+
+import numpy
+
+from seeding import seed_everything, randomize_net, fixed_address_space
+
+__author__ = 'AH'
+
+#Headless, seeded throughput benchmark. Every combination of the scaling knobs (agents, food, rays per agent)
+#gets a fresh cage with one Eater and Team per agent, is warmed up and then stepped like the main loop:
+#Team.Interaction for every agent, then the cage's time step, Team.Learn every few ticks.
+#The time step is taken apart into its stages: forces and sensing of the eaters, the other things,
+#the batched rays (with --batch) and physics. Brain activation is timed on its own, for pybrain and compiled.
+#
+#With --arena TILES the cage is a tiled arena of that many tiles (arena.py), agents and food spread over it.
+#
+#   python -O bench.py --agents 1,4,16 --food 0,80 --rays 3,8 --out bench.json
+#   python -O bench.py --agents 4 --food 2000 --arena 0,25
+
+STAGES = ('tick', 'interaction', 'forces', 'sensing', 'things', 'physics', 'learn', 'brain', 'brain_compiled')
+
+class StageTimer(object):
+    def __init__(self):
+        self.total = dict((s, 0.) for s in STAGES)
+        self.calls = dict((s, 0) for s in STAGES)
+    def add(self, stage, seconds, calls = 1):
+        self.total[stage] += seconds
+        self.calls[stage] += calls
+    def report(self, ticks):
+        #Mean microseconds per call and per tick of every stage that ran
+        stages = {}
+        for s in STAGES:
+            if self.calls[s] == 0: continue
+            stages[s] = {'us_per_call': self.total[s] / self.calls[s] * 1e6, 'us_per_tick': self.total[s] / ticks * 1e6,
+                         'calls': self.calls[s]}
+        return stages
+
+def build_bench_cage(agents, food, rays, batch, streams, arena = 0):
+    from test import build_cage, build_arena, Team
+    from cage import Eater, TaskEat
+    from pybrain.rl.learners import ENAC
+
+    eater_class = type('BenchEater', (Eater,), {'sensors_front': rays})   #The default brain follows the sensor count
+    if arena: cage_env, _, tiles, food_pool = build_arena(None, arena, max(food, 1), batch, streams.seed('env', 0))
+    else: cage_env, _, _, food_pool = build_cage(None, max(food, 1), batch, streams.seed('env', 0))
+    for th in list(cage_env.things):                                  #Drop the scenario's eater, ours come with more rays
+        if isinstance(th, Eater): cage_env.removeThing(th)
+    for t in list(cage_env.tasks): cage_env.tasks.remove(t)
+
+    teams = []
+    for a in range(agents):
+        if arena: eater = eater_class(cage_env, tiles.randomPoint(cage_env.random))
+        else: eater = eater_class(cage_env, (cage_env.random.random_sample()*36-18, 2))
+        randomize_net(eater.brain, streams.stream('brain', a))
+        task = TaskEat(cage_env, eater, food_pool)
+        teams.append(Team(eater, task, ENAC(), streams.stream('explore', a)))
+    for f in range(food):
+        if arena: food_pool.spawn(tiles.randomPoint(cage_env.random, cage_env.random.random_sample()*8+0.5))
+        else: food_pool.spawn((cage_env.random.random_sample()*38-19, cage_env.random.random_sample()*12-4))
+    return cage_env, teams
+
+def timed_step(cage_env, dt, timer):
+    #Same work as CageEnvironment.processTimeStep, but every stage on its own clock
+    from cage import Eater
+    clock = time.time
+    forces = sensing = things = 0.
+    for thing in cage_env.things.updating():
+        if isinstance(thing, Eater):
+            t0 = clock()
+            thing.applyForces(cage_env, dt)
+            t1 = clock()
+            forces += t1 - t0
+            if thing.sensor_batch == None:
+                thing.senseRays(cage_env, dt)
+                sensing += clock() - t1
+        else:
+            t0 = clock()
+            thing.updateState(cage_env, dt)
+            things += clock() - t0
+    if cage_env.sensor_batch != None:
+        t0 = clock()
+        cage_env.sensor_batch.process(cage_env, dt)
+        sensing += clock() - t0
+    t0 = clock()
+    cage_env.space.step(dt)
+    physics = clock() - t0
+    cage_env.steps += 1
+    cage_env._moved()
+
+    timer.add('forces', forces)
+    timer.add('sensing', sensing)
+    timer.add('things', things)
+    timer.add('physics', physics)
+    return forces + sensing + things + physics
+
+def bench_brain(network, inputs, timer):
+    #Activation alone, on a copy so the learning brain's buffers stay untouched
+    from fastnet import CompiledNetwork
+    import copy
+    network = copy.deepcopy(network)
+    network.reset()
+    t0 = time.time()
+    for x in inputs: network.activate(x)
+    timer.add('brain', time.time() - t0, len(inputs))
+    compiled = CompiledNetwork(network)
+    t0 = time.time()
+    for x in inputs: compiled.activate(x)
+    timer.add('brain_compiled', time.time() - t0, len(inputs))
+
+def run_case(agents, food, rays, ticks, warmup, learn_every, batch, seed, arena = 0, fps = 30):
+    streams = seed_everything(seed)
+    cage_env, teams = build_bench_cage(agents, food, rays, batch, streams, arena)
+    dt = 1./fps
+    for _ in range(warmup):
+        for team in teams: team.Interaction()
+        cage_env.processTimeStep(dt)
+    for team in teams: team.agent.reset()
+
+    timer = StageTimer()
+    inputs = []
+    clock = time.time
+    for step in range(ticks):
+        t0 = clock()
+        for team in teams: team.Interaction()
+        interaction = clock() - t0
+        timer.add('interaction', interaction, len(teams))
+        timer.add('tick', interaction + timed_step(cage_env, dt, timer))
+        if len(inputs) < 200: inputs.append(teams[0].living.inbuf.copy())
+        if (step+1) % learn_every == 0:
+            for team in teams:
+                t0 = clock()
+                team.Learn()
+                timer.add('learn', clock() - t0)
+    bench_brain(teams[0].living.brain, inputs, timer)
+
+    busy = timer.total['tick']
+    return {'agents': agents, 'food': food, 'rays': rays, 'batch': batch, 'arena': arena, 'ticks': ticks, 'seed': seed,
+            'ticks_per_sec': ticks / busy if busy > 0 else float('inf'),
+            'ticks_per_sec_with_learn': ticks / (busy + timer.total['learn']),
+            'stages': timer.report(ticks)}
+
+def git_revision():
+    try: return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+def print_case(r):
+    stages = r['stages']
+    print "agents %3i  food %3i  rays %2i%s%s: %8.1f ticks/s" % (r['agents'], r['food'], r['rays'],
+        ' (batch)' if r['batch'] else '', ' arena %i' % r['arena'] if r.get('arena') else '', r['ticks_per_sec'])
+    for s in STAGES:
+        if s in stages:
+            print "    %-15s %10.1f us/call %10.1f us/tick" % (s, stages[s]['us_per_call'], stages[s]['us_per_tick'])
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Headless throughput benchmark of the cage simulation")
+    parser.add_argument('--agents', type = int_list, default = [1, 4], help = "comma separated numbers of agents")
+    parser.add_argument('--food', type = int_list, default = [0, 80], help = "comma separated numbers of food items")
+    parser.add_argument('--rays', type = int_list, default = [3], help = "comma separated numbers of front rays per agent")
+    parser.add_argument('--ticks', type = int, default = 300)
+    parser.add_argument('--warmup', type = int, default = 30)
+    parser.add_argument('--learn-every', type = int, default = 100)
+    parser.add_argument('--batch', action = 'store_true', help = "cast the rays of all agents in one batch")
+    parser.add_argument('--arena', type = int_list, default = [0], help = "comma separated numbers of arena tiles, 0 is the cage")
+    parser.add_argument('--seed', type = int, help = "default 0; given, the run is repeatable across processes")
+    parser.add_argument('--out', help = "write the results as JSON to this file")
+    args = parser.parse_args()
+    if args.seed != None: fixed_address_space()                       #Same seed, same simulation, see seeding.py
+    else: args.seed = 0
+
+    results = []
+    for agents, food, rays, arena in itertools.product(args.agents, args.food, args.rays, args.arena):
+        r = run_case(agents, food, rays, args.ticks, args.warmup, args.learn_every, args.batch, args.seed, arena)
+        print_case(r)
+        results.append(r)
+
+    if args.out:
+        meta = {'revision': git_revision(), 'python': platform.python_version(), 'numpy': numpy.__version__,
+                'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'args': vars(args)}
+        json.dump({'meta': meta, 'results': results}, open(args.out, 'w'), indent = 1, sort_keys = True)
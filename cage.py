@@ -21,6 +21,8 @@ def get_new_collision_group_counter():
     if collision_shape_counter == 0: collision_shape_counter += 1
     return collision_shape_counter
 
+import heapq
+
 import numpy
 
 __author__ = 'AH'
@@ -30,6 +32,8 @@ from pybrain.rl.environments.twoplayergames.twoplayergame import CompetitiveEnvi
 
 
 class Thing(object):                                      #TODO: make derive from ParameterContainer?
+    passive = False                                 #updateState does nothing, time steps skip it
+    static_drawing = False                          #Looks the same every frame, drawn once into CageEnvironment.static_layers
     def __init__(self, env):
         env.embedThing(self)
 
@@ -49,10 +53,15 @@ class Thing(object):                                      #TODO: make derive fro
         pass
             
 class StaticLines(Thing):
-    def __init__(self, env, line_points, radius, color = (1.,1.,1.), friction = 0.1, elasticity = 0.25):
+    passive = True
+    static_drawing = True
+    def __init__(self, env, line_points, radius, color = (1.,1.,1.), friction = 0.1, elasticity = 0.25, static = False):
         #Line_points is a list of 2d points (tuples) 
+        #A static body is left alone by chipmunk: its lines are not rehashed every step, and bodies resting on
+        #them can fall asleep. The indefinite heavy (rogue) body keeps everything it touches awake
         self.color_in = color
-        self.body = pymunk.Body(pymunk.inf, pymunk.inf)         #Make indefinite heavy body
+        if static: self.body = pymunk.Body()
+        else: self.body = pymunk.Body(pymunk.inf, pymunk.inf)   #Make indefinite heavy body
         
         lp_old = None
         self.lines = []
@@ -65,9 +74,11 @@ class StaticLines(Thing):
                 self.lines[-1].elasticity = elasticity
             lp_old = lp
             index += 1
+        xs, ys = [p[0] for p in line_points], [p[1] for p in line_points]
+        self.bounds = min(xs) - radius, min(ys) - radius, max(xs) + radius, max(ys) + radius    #Of the lines, in world space
         Thing.__init__(self, env)
     def removeFromEnv(self, env):
-        env.space.remove_static(self.lines)
+        env.space.remove(self.lines)
     def embedInEnv(self, env):
         env.space.add(self.lines)
     def updateState(self, env, dt):
@@ -117,6 +128,7 @@ class DynamicThing(Thing):
     
 #### Ball with reasonable defaults
 class Ball(DynamicThing):
+    passive = True
     def __init__(self, env, position=(0., 0.), radius = 0.25, density = 30, color = (1.,1.,1.), outline=(0.5,0.5,0.5)):
         self.color_in = color
         self.outline = outline
@@ -160,11 +172,70 @@ class Creature(Thing):
 class Food(Ball):
     def __init__(self, env, position=(0., 0.)):
         Ball.__init__(self, env, position, 0.2, 20, (1.0,1.0,0))
+
+def body_bias(body):
+    #Chipmunk's bias velocities, its position correction is applied in the next step. pymunk does not expose them
+    c = body._body.contents
+    return c.v_bias_private.x, c.v_bias_private.y, c.w_bias_private
+def set_body_bias(body, vx = 0., vy = 0., w = 0.):
+    c = body._body.contents
+    c.v_bias_private.x, c.v_bias_private.y, c.w_bias_private = vx, vy, w
+
+class FoodPool(object):
+    #A fixed set of pre-allocated Food. Spawning embeds a parked one again, releasing removes it from the
+    #environment (pymunk defers that until a running step is done), bodies are never constructed or dropped.
+    #Whether a Food is parked is its membership in env.things, so snapshot restores keep the pool consistent.
+    #The indices of the parked ones are a heap, the lowest is spawned first. It is rebuilt only if env.things
+    #changed behind the pool's back (a restore, say)
+    def __init__(self, env, capacity = 80):
+        self.env = env
+        self.capacity = capacity
+        self.foods = []
+        for i in range(capacity):
+            food = Food(env)
+            env.removeThing(food)
+            self.foods.append(food)
+        self.index = dict((f, i) for i, f in enumerate(self.foods))
+        self._resync()
+    def _resync(self):
+        self.free = [i for i, f in enumerate(self.foods) if f not in self.env.things]      #Sorted, so a heap
+        self.synced = self.env.things.changes
+    def _parked(self):
+        if self.synced != self.env.things.changes: self._resync()
+        return self.free
+    @property
+    def active(self):
+        return self.capacity - len(self._parked())
+    
+    def spawn(self, position, clearance = 0.):     #None once the cap is reached, or if env.spatial knows a thing closer than clearance
+        if clearance > 0. and self.env.spatial != None and not self.env.spatial.isClear(position, clearance): return None
+        free = self._parked()
+        if not free: return None
+        food = self.foods[heapq.heappop(free)]
+        body = food.body
+        body.position = position
+        body.velocity = 0., 0.
+        body.angle = 0.
+        body.angular_velocity = 0.
+        body.reset_forces()
+        set_body_bias(body)                         #Left over if it was eaten during a step
+        self.env.embedThing(food)
+        self.synced = self.env.things.changes
+        return food
+    def release(self, food):
+        #Whether food was parked, False if it already was, e.g. by another eater touching it in the same step
+        if food not in self.env.things: return False
+        free = self._parked()
+        self.env.removeThing(food)
+        heapq.heappush(free, self.index[food])
+        self.synced = self.env.things.changes
+        return True
         
 
 #SensorRay querying information on a contained linespace about the environment
 class SensorRay(object):
     def __init__(self, inner_radius, radius, angle):
+        self.results = numpy.zeros(4)
         self.setInitParams(inner_radius, radius, angle)
     def setInitParams(self, inner_radius, radius, angle, fadeout = 0.60):
         self.inner_radius = inner_radius                                  #This space will be ignored, ray starting outside inner_radius
@@ -177,7 +248,7 @@ class SensorRay(object):
     def _zero(self):
         self.owner_hit = None
         self.normal_hit = None
-        self.results = numpy.array([0.]*4)
+        self.results[:] = 0.                                             #In place, results may be a view into a SensorBatch
         self.results[3] = 1.         
     def updateSegment(self, pos, orientation, flipy):
         direction = orientation.rotated(self.angle)                       #0 Degrees means pointing to the right
@@ -215,6 +286,107 @@ class SensorRay(object):
     def distance(self):
         return self.results[3]
 
+#SensorBatch casting the rays of all registered livings in one pass
+class SensorBatch(object):
+    #Start and end points of every ray are computed as (n_agents, n_rays, 2) arrays. The results
+    #of all rays live in one (n_agents, n_rays, 4) array, each SensorRay.results is a view into it
+    def __init__(self):
+        self.livings = []
+        self._allocate(0, 0)
+    def _allocate(self, n_agents, n_rays):
+        self.results = numpy.zeros((n_agents, n_rays, 4))
+        self.results[:, :, 3] = 1.
+        self.inner_radius = numpy.zeros((n_agents, n_rays, 1))
+        self.radius = numpy.zeros((n_agents, n_rays, 1))
+        self.fadeout = numpy.zeros((n_agents, n_rays))
+        self.cos = numpy.zeros((n_agents, n_rays))
+        self.sin = numpy.zeros((n_agents, n_rays))
+        self.valid = numpy.zeros((n_agents, n_rays), dtype=bool)      #Agents with less rays are padded
+        self.hit = numpy.zeros((n_agents, n_rays), dtype=bool)
+        self.known = numpy.zeros((n_agents, n_rays), dtype=bool)
+        self.colors = numpy.zeros((n_agents, n_rays, 3))
+        self.t = numpy.ones((n_agents, n_rays))
+        self.pos = numpy.zeros((n_agents, 1, 2))
+        self.look = numpy.zeros((n_agents, 1, 2))
+        for i in range(n_agents):
+            for j, s in enumerate(self.livings[i].sensors):
+                self.results[i, j] = s.results                                 #Keep what has been sensed so far
+                s.results = self.results[i, j]
+                self.inner_radius[i, j] = s.inner_radius
+                self.radius[i, j] = s.radius
+                self.fadeout[i, j] = s.fadeout
+                self.cos[i, j] = numpy.cos(s.angle)
+                self.sin[i, j] = numpy.sin(s.angle)
+                self.valid[i, j] = True
+    @property
+    def n_rays(self):
+        return self.results.shape[1]
+    def register(self, living):
+        if living in self.livings: return
+        self.livings.append(living)
+        living.sensor_batch = self
+        self._allocate(len(self.livings), max(self.n_rays, len(living.sensors)))
+    def unregister(self, living):
+        if living not in self.livings: return
+        self.livings.remove(living)
+        living.sensor_batch = None
+        for s in living.sensors: s.results = s.results.copy()         #Detach from the shared buffer
+        self._allocate(len(self.livings), max([len(l.sensors) for l in self.livings] + [0]))
+
+    def process(self, env, dt):
+        n = len(self.livings)
+        if n == 0: return
+        for i, living in enumerate(self.livings):
+            p = living.body.position
+            self.pos[i, 0, 0], self.pos[i, 0, 1] = p.x, p.y
+            self.look[i, 0, 0], self.look[i, 0, 1] = living.look_at.x, living.look_at.y
+        #Direction is the orientation rotated by the ray's angle, y flipped when looking to the left
+        lx, ly = self.look[:, :, 0], self.look[:, :, 1]
+        direction = numpy.empty(self.results.shape[:2] + (2,))
+        direction[:, :, 0] = lx*self.cos - ly*self.sin
+        direction[:, :, 1] = lx*self.sin + ly*self.cos
+        direction[:, :, 1] *= numpy.where(lx < 0., -1., 1.)
+        start = direction * self.inner_radius + self.pos
+        end = direction * self.radius + self.pos
+        
+        #The queries themselves, one flat pass over all rays of all agents
+        query = env.space.segment_query_first
+        self.hit[:] = False
+        self.known[:] = False
+        for i, living in enumerate(self.livings):
+            group = living.shape.group
+            for j, s in enumerate(living.sensors):
+                sq = query(tuple(start[i, j]), tuple(end[i, j]), group = group)
+                if sq == None:
+                    s.owner_hit = None
+                    s.normal_hit = None
+                    continue
+                self.hit[i, j] = True
+                owner = getattr(sq.shape, 'owner', None)
+                if owner == None: continue                                    #We don't know that thing...
+                self.known[i, j] = True
+                s.normal_hit = sq.n
+                s.owner_hit = owner
+                self.colors[i, j] = owner.color
+                self.t[i, j] = sq.t
+        
+        #Same buffering as SensorRay.processSegment, for all rays at once
+        res = self.results
+        miss = self.valid & ~self.hit
+        res[miss, :3] *= self.fadeout[miss][:, None]                          #Fade out the color to give it some kind of memory
+        res[miss, 3] = 1.
+        known = self.known
+        res[known, :3] += (self.colors[known] - res[known, :3]) * self.fadeout[known][:, None]
+        res[known, 3] = self.t[known]
+        
+        for i, living in enumerate(self.livings):
+            if env.rendering:
+                for j, s in enumerate(living.sensors):
+                    s.start = pymunk.Vec2d(start[i, j])
+                    s.end = pymunk.Vec2d(end[i, j])
+                    s.draw(env)
+            living.sensed(env, dt)
+
 from pybrain.tools.shortcuts import buildNetwork
 from pybrain.structure import * #RecurrentNetwork, LinearLayer, SigmoidLayer, FullConnection
 from pybrain.rl.environments import Task, EpisodicTask
@@ -225,7 +397,7 @@ class Living(Creature):                             #Gets a brain and processing
         self.indim = indim
         self.outdim = outdim
         self.inbuf = numpy.array([0.]*self.indim)                   #All the sensory and of course mostly dynamic inputs to the brain
-        self.outbuf = numpy.empty(self.outdim)                      #The processed and to be used output 
+        self.outbuf = numpy.zeros(self.outdim)                      #The processed and to be used output, idle until the first action
         
         self._createBrain()
         
@@ -237,6 +409,7 @@ class TaskLiving(EpisodicTask):
         self.start_point = start_point
         self.living = living
         Task.__init__(self, env)
+        env.tasks.append(self)
         self.max_samples = max_samples
         
     @property
@@ -291,6 +464,8 @@ class Eater(Ball, Living):
     sensors_front = 3
     sensor_radius = 10.
     did_jump = False
+    sensor_batch = None
+    passive = False
     def __init__(self, env, position=(0., 0.), energy = 1.0, fixed_color = None):
         Ball.__init__(self, env, position, 0.25, 50, (1.,1.,1.), (0.5,0.5,0.5))
         self.fixed_color = fixed_color                          #You could fix the color manually (reducing agents' variety)
@@ -300,6 +475,16 @@ class Eater(Ball, Living):
         self._setSensorRays(0, 3.1416/3, self.sensors_front)
         self.jump_time = 0.
         Living.__init__(self, 2+(2+self.sensors_front)*4, 6, env, position, energy)
+        self._attachSensors(env)
+        
+    def _attachSensors(self, env):
+        if env.sensor_batch != None: env.sensor_batch.register(self)
+    def embedInEnv(self, env):
+        Ball.embedInEnv(self, env)
+        if hasattr(self, 'sensors'): self._attachSensors(env)            #Not yet during construction
+    def removeFromEnv(self, env):
+        Ball.removeFromEnv(self, env)
+        if self.sensor_batch != None: self.sensor_batch.unregister(self)
 
     def _setSensorRays(self,start_angle, end_angle, nr):
         self.sensors = []
@@ -336,6 +521,15 @@ class Eater(Ball, Living):
         self.brain = n
 
     def updateState(self, env, dt):
+        self.applyForces(env, dt)
+        if self.sensor_batch != None: return                       #Rays get cast for all agents at once, then sensed() is called
+        if env.profiler != None:
+            t = env.profiler.clock()
+            self.senseRays(env, dt)
+            env.profiler.since('sensors', t)
+        else: self.senseRays(env, dt)
+        
+    def applyForces(self, env, dt):
         self.did_jump = False
         self.energy -= dt*self.decay
         #Keep it straight
@@ -367,13 +561,23 @@ class Eater(Ball, Living):
         force = pymunk.Vec2d(self.body.rotation_vector) * force
         if force != float('nan'):
             self.body.apply_force(force)
+    def senseRays(self, env, dt):
         #Update sensors
         for s in self.sensors:
             flipy = False
             if self.look_at.x < 0: flipy = True
             s.updateSegment(self.body.position, self.look_at, flipy)
             s.processSegment(env, self.shape.group)
-            s.draw(env)
+            if env.rendering: s.draw(env)
+        self.sensed(env, dt)
+        
+    def respawn(self, position):                                   #Teleport with fresh energy and blank senses
+        self.energy = 1.0
+        self.body.position = position
+        for s in self.sensors: s._zero()
+        self._fillInBuf()
+        
+    def sensed(self, env, dt):                                     #Everything depending on fresh sensor results
         #Jump      
         if self.jump and self.jump_time > 0.3:
             if self.sensors[0].distance < 0.005*self.sensors[0].radius: 
@@ -430,20 +634,123 @@ def collision_func(space, arbiter, env, methodname):
     return handle
     return True
 
+from collections import OrderedDict
+class ThingRegistry(object):
+    #Ordered set of things with O(1) membership, key lookup and removal. Every thing is also filed
+    #under each Thing class it is an instance of, so type counts and type queries don't scan
+    def __init__(self):
+        self._keys = OrderedDict()                          #thing -> key handed out when it was added
+        self._buckets = {}                                  #class -> OrderedDict of its things
+        self._updating = OrderedDict()                      #The things that are not passive
+        self._next_key = 0
+        self.changes = 0                                    #Counts adds, removes and reorders
+    def __iter__(self):
+        return iter(self._keys)
+    def __len__(self):
+        return len(self._keys)
+    def __contains__(self, th):
+        return th in self._keys
+    def index(self, th):                                    #Position as in a list, scans
+        for i, other in enumerate(self._keys):
+            if other is th: return i
+        raise ValueError("Thing not in registry")
+    def key(self, th):                                      #Stable id of th while it stays, not its position
+        return self._keys[th]
+    
+    def _classes(self, th):
+        return [c for c in type(th).__mro__ if issubclass(c, Thing)]
+    def add(self, th):
+        if th in self._keys: return self._keys[th]
+        self._keys[th] = self._next_key
+        self._next_key += 1
+        for c in self._classes(th): self._buckets.setdefault(c, OrderedDict())[th] = True
+        if not th.passive: self._updating[th] = True
+        self.changes += 1
+        return self._keys[th]
+    def remove(self, th):
+        del self._keys[th]
+        for c in self._classes(th): del self._buckets[c][th]
+        self._updating.pop(th, None)
+        self.changes += 1
+    def reorder(self, things):                              #Same things, given order
+        keys = self._keys
+        self._keys = OrderedDict((th, keys[th]) for th in things)
+        self._buckets = {}
+        for th in things:
+            for c in self._classes(th): self._buckets.setdefault(c, OrderedDict())[th] = True
+        self._updating = OrderedDict((th, True) for th in things if not th.passive)
+        self.changes += 1
+    
+    def countType(self, cls):
+        return len(self._buckets.get(cls, ()))
+    def ofType(self, cls):
+        return list(self._buckets.get(cls, ()))
+    def updating(self):                                     #In order, without the passive things
+        return iter(self._updating)
+
+class StaticLayers(object):
+    #Things with static_drawing pre-rasterized into a surface per view, each frame blits it in one go. A view
+    #is the surface size and the transform, the last `capacity` ones are kept (the screen's and a video
+    #recorder's, say). Zoom and pan render a new one, adding or removing a static thing drops them all.
+    #Only the things whose bounds overlap the view are drawn
+    key_color = (1, 2, 3)                           #Transparent, nothing static should have it
+    def __init__(self, capacity = 4):
+        self.capacity = capacity
+        self.layers = OrderedDict()
+        self.renders = 0
+    def invalidate(self):
+        self.layers.clear()
+    def layer(self, env):
+        key = (env.surface.get_size(), env.scale, env.offset_x, env.offset_y)
+        srf = self.layers.pop(key, None)
+        if srf == None:
+            srf = self._render(env)
+            if len(self.layers) >= self.capacity: self.layers.popitem(False)
+        self.layers[key] = srf                      #Most recently used
+        return srf
+    def _render(self, env):
+        w, h = env.surface.get_size()
+        srf = pygame.Surface((w, h), 0, 32)
+        srf.fill(self.key_color)
+        srf.set_colorkey(self.key_color, RLEACCEL)
+        x0, x1 = -env.offset_x / env.scale, (w - env.offset_x) / env.scale          #The view in world space
+        y0, y1 = (env.offset_y - h) / env.scale, env.offset_y / env.scale
+        screen = env.surface
+        env.surface = srf
+        try:
+            for th in env.things:
+                if not th.static_drawing: continue
+                b = getattr(th, 'bounds', None)
+                if b != None and (b[2] < x0 or b[0] > x1 or b[3] < y0 or b[1] > y1): continue
+                th.draw(env)
+        finally: env.surface = screen
+        self.renders += 1
+        return srf
+
+from spatial import SpatialGrid
 class CageEnvironment():
     
-    things = []
     steps = 0
+    profiler = None                         #A profiler.TickProfiler, if set every stage of a time step is timed
+    spatial = None                          #A spatial.SpatialGrid over the dynamic things, see enableSpatialIndex
+    static_layers = None                    #StaticLayers, None draws static things one by one every frame
     
-    def __init__(self, surface, gravity = 9.81, xdim = 200., focus = (0.,0.)):
-        self.space = pymunk.Space()
-        self.space.gravity = (0., -gravity)
-        
-        self.space.add_collision_handler(0, 0, lambda space, arbiter, env: collision_func(space, arbiter, env, "receiveOnBegin"), None, None, lambda space, arbiter, env: collision_func(space, arbiter, env, "receiveOnSeparate"), self)
-        #Limit the callbacks a little bit
-        self.surface = surface
-        self.setViewPort(xdim, focus)
+    def __init__(self, surface, gravity = 9.81, xdim = 200., focus = (0.,0.), batch_sensors = False, seed = None):
+        self.things = ThingRegistry()       #Per instance, several environments may live in one process
+        self.random = numpy.random.RandomState(seed)                #Events of the world (food, respawns), apart from learning
+        self.tasks = []                     #TaskLivings register themselves, their counters are part of snapshots
+        self.sensor_batch = None
+        if batch_sensors: self.sensor_batch = SensorBatch()          #Cast all rays of all agents in one pass
+        self.space = self._newSpace((0., -gravity))
+        self.static_layers = StaticLayers()
+        self.scale, self.offset_x, self.offset_y = 1., 0., 0.
+        self.setSurface(surface, xdim, focus)
  
+    def setSurface(self, surface, xdim = None, focus = (0.,0.)):
+        #Without a surface the environment runs headless: no draw() call is ever issued
+        self.surface = surface
+        self.rendering = surface != None
+        if self.rendering: self.setViewPort(xdim, focus)
     def setViewPort(self, xdim, focus):
         if xdim != None: self.scale = self.surface.get_width() / xdim
         self.offset_x = self.surface.get_width() / 2. - focus[0]*self.scale
@@ -455,25 +762,199 @@ class CageEnvironment():
     def transformDimension2Screen(self, dim):
         return dim * self.scale
 
+    def _newSpace(self, gravity, damping = 1.):
+        space = pymunk.Space()
+        space.gravity = gravity
+        space.damping = damping
+        space.add_collision_handler(0, 0, lambda space, arbiter, env: collision_func(space, arbiter, env, "receiveOnBegin"), None, None, lambda space, arbiter, env: collision_func(space, arbiter, env, "receiveOnSeparate"), self)
+        #Limit the callbacks a little bit
+        return space
+    def renewSpace(self):
+        #The same things in a new chipmunk space, added in the order of the registry. Chipmunk's caches and
+        #hash sets only grow and their order depends on everything that happened, a new space forgets it all
+        old = self.space
+        for th in self.things: th.removeFromEnv(self)
+        self.space = self._newSpace(old.gravity, old.damping)
+        self.space.sleep_time_threshold = old.sleep_time_threshold
+        self.space.idle_speed_threshold = old.idle_speed_threshold
+        for th in self.things: th.embedInEnv(self)
+
+    def enableSpatialIndex(self, cell = 2.):
+        #Neighbourhood queries (food proximity, free spots, analytics) without scanning all things. Every time
+        #step only marks the grid outdated, it is rebuilt by the first query after
+        self.spatial = SpatialGrid(cell, lambda: self.things.ofType(DynamicThing))
+        return self.spatial
+    def _moved(self):
+        if self.spatial != None: self.spatial.invalidate()
+
     def embedThing (self, th):              #Creatures and other things usually embed themselves upon construction
-        if self.things.count(th) > 0: return self.things.index(th)
-        self.things.append(th)
+        if th in self.things: return self.things.index(th)
+        self.things.add(th)
         th.embedInEnv(self)
-        return len(self.things)-1
+        self._moved()
+        if th.static_drawing and self.static_layers != None: self.static_layers.invalidate()
+        return len(self.things)-1                           #Position, as with a list
     def removeThing(self, th):
         self.things.remove(th)             #... and remove themselves (from the darwin pool :) if necessary
         th.removeFromEnv(self)
+        self._moved()
+        if th.static_drawing and self.static_layers != None: self.static_layers.invalidate()
         
     def processTimeStep(self, timestep):
+        if self.profiler != None: return self._profiledTimeStep(timestep)
         #Update all Things' states
-        for thing in self.things:
+        for thing in self.things.updating():
             thing.updateState(self, timestep)
+        if self.sensor_batch != None: self.sensor_batch.process(self, timestep)
         #Bring physics forward
         self.space.step(timestep)
+        self.steps += 1
+        self._moved()
+    def _profiledTimeStep(self, timestep):
+        prof = self.profiler
+        start = t = prof.clock()
+        for thing in self.things.updating():
+            thing.updateState(self, timestep)
+            t = prof.since('update:' + thing.__class__.__name__, t)
+        t = prof.since('things', start)
+        if self.sensor_batch != None:
+            self.sensor_batch.process(self, timestep)
+            t = prof.since('sensors', t)
+        self.space.step(timestep)
+        prof.since('space.step', t)
+        self.steps += 1
+        self._moved()
+        
+    def snapshot(self):
+        return CageSnapshot(self)
+    def restore(self, snap, fresh = False):
+        snap.restoreInto(self, fresh)
         
     def drawThings(self):
-        for thing in self.things: thing.draw(self)
+        if not self.rendering: return
+        if self.profiler != None: t = self.profiler.clock()
+        layers = self.static_layers
+        if layers != None: self.surface.blit(layers.layer(self), (0, 0))
+        for thing in self.things:
+            if layers == None or not thing.static_drawing: thing.draw(self)
+        if self.profiler != None: self.profiler.since('draw', t)
                     
+from fastnet import net_state, set_net_state
+class CageSnapshot(object):
+    #Array backed state of a CageEnvironment: which things are in, every dynamic body, the sensors,
+    #livings (buffers, energy, brain state) and the counters of registered tasks
+    body_fields = 12                                                    #x, y, vx, vy, angle, angular velocity, fx, fy, torque, bias vx, vy, w
+    living_scalars = 5                                                  #energy, jump_time, did_jump, look_at x, y
+    def __init__(self, env):
+        self.steps = env.steps
+        self.random_state = env.random.get_state()
+        self.things = list(env.things)
+        self.dynamic = [th for th in self.things if isinstance(th, DynamicThing)]
+        self.bodies = numpy.empty((len(self.dynamic), self.body_fields))
+        for i, th in enumerate(self.dynamic):
+            b = th.body
+            self.bodies[i] = (b.position.x, b.position.y, b.velocity.x, b.velocity.y, b.angle, b.angular_velocity,
+                              b.force.x, b.force.y, b.torque) + body_bias(b)
+        
+        self.livings = [th for th in self.things if isinstance(th, Living)]
+        self.sensors = [s for l in self.livings for s in getattr(l, 'sensors', [])]
+        self.sensor_results = numpy.array([s.results for s in self.sensors]).reshape(-1, 4)
+        self.sensor_hits = [(s.owner_hit, s.normal_hit) for s in self.sensors]
+        self.inbufs = numpy.array([l.inbuf for l in self.livings])
+        self.outbufs = numpy.array([l.outbuf for l in self.livings])
+        self.scalars = numpy.zeros((len(self.livings), self.living_scalars))
+        for i, l in enumerate(self.livings):
+            look_at = getattr(l, 'look_at', (0., 0.))
+            self.scalars[i] = (l.energy, getattr(l, 'jump_time', 0.), getattr(l, 'did_jump', False), look_at[0], look_at[1])
+        self.brains = [net_state(l.brain) for l in self.livings]
+        
+        self.tasks = list(env.tasks)
+        self.task_counters = [dict((k, v) for k, v in t.__dict__.items() if isinstance(v, (bool, int, long, float, numpy.number)))
+                              for t in self.tasks]
+        
+    def restoreInto(self, env, fresh = False):
+        #With fresh the things go into a new chipmunk space (CageEnvironment.renewSpace), what follows
+        #depends on the snapshot only and not on what the environment did before
+        env.steps = self.steps
+        env.random.set_state(self.random_state)
+        present = set(env.things)
+        wanted = set(self.things)
+        for th in list(env.things):
+            if th not in wanted: env.removeThing(th)
+        for th in self.things:
+            if th not in present: env.embedThing(th)
+        env.things.reorder(self.things)                                 #Same update order as before
+        if fresh: env.renewSpace()
+        
+        for th, row in zip(self.dynamic, self.bodies):
+            b = th.body
+            b.position = row[0], row[1]
+            b.velocity = row[2], row[3]
+            b.angle = row[4]
+            b.angular_velocity = row[5]
+            b.force = row[6], row[7]
+            b.torque = row[8]
+            set_body_bias(b, *row[9:12])
+            env.space.reindex_shape(th.shape)                               #Sensor queries before the next step see the new position
+        env._moved()
+        for s, row, (owner, normal) in zip(self.sensors, self.sensor_results, self.sensor_hits):
+            s.results[:] = row                                           #In place, may be a SensorBatch view
+            s.owner_hit, s.normal_hit = owner, normal
+        for i, l in enumerate(self.livings):
+            l.inbuf[:] = self.inbufs[i]
+            l.outbuf = self.outbufs[i].copy()
+            energy, jump_time, did_jump, lx, ly = self.scalars[i]
+            l.energy = energy
+            if hasattr(l, 'jump_time'):
+                l.jump_time, l.did_jump = jump_time, bool(did_jump)
+                l.setLookAt(pymunk.Vec2d(lx, ly))
+            set_net_state(l.brain, self.brains[i])
+        for t, counters in zip(self.tasks, self.task_counters): t.__dict__.update(counters)
+
+class VectorCageEnvironment(object):
+    #K independent (CageEnvironment, TaskLiving) pairs stepped in lockstep. Observations, actions, rewards
+    #and done flags are stacked into preallocated arrays, which are reused by the next call.
+    #make_cage(k) builds the k-th pair, the optional housekeeping(env, task, steps) runs once per step and cage
+    def __init__(self, make_cage, n, timestep = 1./30, housekeeping = None):
+        self.envs, self.tasks = [], []
+        for k in range(n):
+            env, task = make_cage(k)
+            self.envs.append(env)
+            self.tasks.append(task)
+        self.timestep = timestep
+        self.housekeeping = housekeeping
+        living = self.tasks[0].living
+        self.indim, self.outdim = living.indim, living.outdim      #Observation and action size, as seen by the brains
+        self.observations = numpy.zeros((n, self.indim))
+        self.rewards = numpy.zeros(n)
+        self.dones = numpy.zeros(n, dtype=bool)
+        self.steps = numpy.zeros(n, dtype=int)
+    def __len__(self):
+        return len(self.envs)
+        
+    def _resetCage(self, k):
+        task = self.tasks[k]
+        task.reset()
+        if hasattr(task.living, 'respawn'): task.living.respawn(task.start_point)
+        self.observations[k] = task.getObservation()
+    def reset(self):
+        for k in range(len(self.envs)): self._resetCage(k)
+        return self.observations
+        
+    def step(self, actions):
+        #Same order as Team.Interaction followed by processTimeStep in the main loop: done is decided
+        #before the step, whose collisions may restart the task's countdown
+        for k, (env, task) in enumerate(zip(self.envs, self.tasks)):
+            task.performAction(numpy.array(actions[k], dtype=float))
+            self.rewards[k] = task.getReward()
+            self.dones[k] = task.isFinished()
+            if self.dones[k]: self._resetCage(k)                  #Auto reset, the observation is the first of the new episode
+            env.processTimeStep(self.timestep)
+            if self.housekeeping != None: self.housekeeping(env, task, self.steps[k])
+            self.steps[k] += 1
+            self.observations[k] = task.getObservation()
+        return self.observations, self.rewards, self.dones
+
 
 class TaskAvoidRed(TaskLiving):
     min_reward = 0.
@@ -518,16 +999,19 @@ from cage2 import CollisionReceiver
 class TaskEat(TaskLiving, CollisionReceiver):
     success = False
     failure = False    
-    def __init__(self, env, living):
+    proximity_reward = 0.                           #For the nearest food within proximity_radius, more the closer. Needs env.spatial
+    proximity_radius = 3.
+    def __init__(self, env, living, food_pool = None):
         TaskLiving.__init__(self, env, living)
         CollisionReceiver.__init__(self, living.shape)
+        self.food_pool = food_pool                  #If given, eaten food goes back into it
         
         self.living.decay = 0.01
         self.collected = 0.
         
     def receiveOnBegin(self, thing, contacts):
         if isinstance(thing, Food):
- #           self.env.removeThing(thing)
+            if self.food_pool != None and not self.food_pool.release(thing): return False      #Eaten by someone else
             self.living.energy += 0.1
             self.collected += 1.
             self.countdown()
@@ -545,6 +1029,9 @@ class TaskEat(TaskLiving, CollisionReceiver):
                 reward += 0.0# * (1. - s.results[3])
         if isinstance(self.living.sensors[0].owner_hit, Food) and self.living.did_jump:
             reward -= 1
+        if self.proximity_reward and self.env.spatial != None:
+            near = self.env.spatial.nearest(self.living.body.position, 1, Food, max_radius = self.proximity_radius)
+            if near: reward += self.proximity_reward * (1. - near[0][0] / self.proximity_radius)
         
         #reward -= 0.1
         reward += 100 * self.collected 
@@ -51,6 +51,8 @@ class CollisionVisualizer(Thing, CollisionReceiver):
     
     def updateState(self, env, dt):                
         self.updated = True
+    def removeFromEnv(self, env):                   #Owns no bodies or shapes, the receiver stays on its shape
+        return None
     def draw(self, env):
         import pygame
         for _, collisions in self.draw_dict.iteritems():
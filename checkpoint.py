@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+import collections
+import json
+import os
+import Queue
+import struct
+import threading
+
+import numpy
+
+__author__ = 'AH'
+
+from pybrain.structure import LinearLayer, TanhLayer, SigmoidLayer, SoftmaxLayer, BiasUnit, LSTMLayer
+from pybrain.structure import FullConnection, IdentityConnection, FeedForwardNetwork, RecurrentNetwork
+
+from fastnet import param_layout, net_state, set_net_state
+
+#Versioned binary brain checkpoints instead of pickled pybrain objects. A file is
+#   magic, version, header length, JSON header, raw arrays (each aligned to 64 bytes)
+#The header describes the topology (modules, connections and where every container's parameters are in
+#the flat params array) and every array's dtype, shape and file offset, so arrays can be memory-mapped.
+#Optional: the network's activation state (LSTM cells and last outputs) and a learner's optimizer state.
+#
+#   python checkpoint.py convert Eat_first_attempt.p [more.p ...]       writes Eat_first_attempt.brain
+#   python checkpoint.py check Eat_first_attempt.p [more.brain ...]     save, load and activate with state
+
+MAGIC = 'AATBRAIN'
+VERSION = 1
+ALIGN = 64
+
+network_classes = {'FeedForwardNetwork': FeedForwardNetwork, 'RecurrentNetwork': RecurrentNetwork}
+module_classes = dict((c.__name__, c) for c in (LinearLayer, TanhLayer, SigmoidLayer, SoftmaxLayer, BiasUnit, LSTMLayer))
+connection_classes = dict((c.__name__, c) for c in (FullConnection, IdentityConnection))
+optimizer_scalars = ('alpha', 'alphadecay', 'momentum', 'rprop', 'deltamax', 'deltamin', 'deltanull', 'etaplus', 'etaminus')
+optimizer_arrays = ('values', 'momentumvector', 'lastgradient', 'rprop_theta')
+
+def _module_descriptor(m):
+    name = m.__class__.__name__
+    if name not in module_classes: raise NotImplementedError("Cannot store module %s" % name)
+    d = {'class': name, 'name': m.name, 'dim': m.dim}
+    if name == 'LSTMLayer': d['peepholes'] = bool(m.peepholes)
+    return d
+def _connection_descriptor(c, recurrent):
+    name = c.__class__.__name__
+    if name not in connection_classes: raise NotImplementedError("Cannot store connection %s" % name)
+    return {'class': name, 'name': c.name, 'inmod': c.inmod.name, 'outmod': c.outmod.name, 'recurrent': recurrent,
+            'slices': [c.inSliceFrom, c.inSliceTo, c.outSliceFrom, c.outSliceTo]}
+
+def topology(network):
+    #JSON-able description of a sorted network, enough to build it again
+    if not network.sorted: network.sortModules()
+    name = network.__class__.__name__
+    if name not in network_classes: raise NotImplementedError("Cannot store network %s" % name)
+    connections = [_connection_descriptor(c, False) for m in network.modulesSorted for c in network.connections[m]]
+    connections += [_connection_descriptor(c, True) for c in getattr(network, 'recurrentConns', [])]
+    return {'class': name, 'name': network.name,
+            'modules': [_module_descriptor(m) for m in network.modulesSorted],
+            'inmodules': [m.name for m in network.inmodules], 'outmodules': [m.name for m in network.outmodules],
+            'connections': connections,
+            'layout': [[c.name, offset, length] for c, offset, length in param_layout(network)]}
+
+def build_network(descr):
+    network = network_classes[descr['class']](name = descr['name'])
+    modules = {}
+    for d in descr['modules']:
+        cls = module_classes[d['class']]
+        if cls == BiasUnit: m = BiasUnit(name = d['name'])
+        elif cls == LSTMLayer: m = LSTMLayer(d['dim'], d['peepholes'], name = d['name'])
+        else: m = cls(d['dim'], name = d['name'])
+        modules[d['name']] = m
+        if d['name'] in descr['inmodules']: network.addInputModule(m)
+        elif d['name'] in descr['outmodules']: network.addOutputModule(m)
+        else: network.addModule(m)
+    for d in descr['connections']:
+        f, t, of, ot = d['slices']
+        c = connection_classes[d['class']](modules[d['inmod']], modules[d['outmod']], name = d['name'],
+                                           inSliceFrom = f, inSliceTo = t, outSliceFrom = of, outSliceTo = ot)
+        if d['recurrent']: network.addRecurrentConnection(c)
+        else: network.addConnection(c)
+    network.sortModules()
+    return network
+
+def _param_index(network, layout):
+    #For every entry of the new network's params, where it is in the stored array (matched by container name)
+    stored = dict((name, (offset, length)) for name, offset, length in layout)
+    index = numpy.empty(network.paramdim, dtype=int)
+    for c, offset, length in param_layout(network):
+        src, src_length = stored[c.name]
+        if src_length != length: raise ValueError("Parameters of %s do not match the stored topology" % c.name)
+        index[offset:offset+length] = numpy.arange(src, src+length)
+    return index
+
+def checkpoint_arrays(network, dtype = numpy.float64, state = False, learner = None, meta = None, descr = None):
+    #Header and copies of all arrays of a checkpoint, e.g. to be written later. descr: a cached topology()
+    arrays = [('params', numpy.array(network.params, dtype = dtype))]
+    header = {'network': descr or topology(network), 'meta': meta or {}}
+    if state:
+        offset, buffers = net_state(network)
+        header['state_offset'] = offset
+        for m, bufs in zip(network.modulesSorted, buffers):
+            for (name, _), b in zip(m.bufferlist, bufs): arrays.append(('state/%s/%s' % (m.name, name), b))
+    if learner != None and hasattr(learner, 'gd'):
+        gd = learner.gd
+        header['optimizer'] = dict((k, getattr(gd, k)) for k in optimizer_scalars)
+        for k in optimizer_arrays:
+            if getattr(gd, k, None) is not None: arrays.append(('optimizer/' + k, numpy.array(getattr(gd, k), dtype = float)))
+    return header, arrays
+
+def save_checkpoint(network, filename, dtype = numpy.float64, state = False, learner = None, meta = None):
+    #state: also store the activation state, learner: also store its gradient descent state
+    header, arrays = checkpoint_arrays(network, dtype, state, learner, meta)
+    write_arrays(filename, header, arrays)
+
+def write_arrays(filename, header, arrays):
+    #Offsets are relative to the start of the data section, which begins after the padded header
+    position = 0
+    entries = {}
+    for name, a in arrays:
+        a = numpy.ascontiguousarray(a)
+        entries[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': position}
+        position += -(-a.nbytes // ALIGN) * ALIGN
+    header = dict(header, arrays = entries)
+    text = json.dumps(header, sort_keys = True)
+    start = 8 + 8 + len(text)
+    data_start = -(-start // ALIGN) * ALIGN
+    f = open(filename, 'wb')
+    try:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', VERSION, len(text)))
+        f.write(text)
+        f.write('\0' * (data_start - start))
+        for name, a in arrays:
+            a = numpy.ascontiguousarray(a)
+            f.seek(data_start + entries[name]['offset'])
+            f.write(a.tostring())
+        f.truncate(data_start + position)
+    finally:
+        f.close()
+
+def is_checkpoint(filename):
+    f = open(filename, 'rb')
+    try: return f.read(len(MAGIC)) == MAGIC
+    finally: f.close()
+
+def read_checkpoint(filename):
+    #The header and every array as a read-only memory map (zero-copy)
+    f = open(filename, 'rb')
+    try:
+        if f.read(len(MAGIC)) != MAGIC: raise ValueError("%s is not a brain checkpoint" % filename)
+        version, length = struct.unpack('<II', f.read(8))
+        if version > VERSION: raise ValueError("%s has checkpoint version %i, only up to %i is known" % (filename, version, VERSION))
+        header = json.loads(f.read(length))
+    finally:
+        f.close()
+    data_start = -(-(16 + length) // ALIGN) * ALIGN
+    arrays = {}
+    for name, e in header['arrays'].iteritems():
+        shape = tuple(e['shape'])
+        if numpy.prod(shape) == 0: arrays[name] = numpy.zeros(shape, dtype = e['dtype'])
+        else: arrays[name] = numpy.memmap(filename, e['dtype'], 'r', data_start + e['offset'], shape)
+    return header, arrays
+
+def load_checkpoint(filename, state = True):
+    #Returns the rebuilt network and the header. The activation state is restored if stored and asked for
+    header, arrays = read_checkpoint(filename)
+    network = build_network(header['network'])
+    network._setParameters(numpy.asarray(arrays['params'], dtype = float)[_param_index(network, header['network']['layout'])])
+    if state and 'state_offset' in header:
+        buffers = [[arrays['state/%s/%s' % (m.name, name)] for name, _ in m.bufferlist] for m in network.modulesSorted]
+        set_net_state(network, (header['state_offset'], buffers))
+    return network, header
+
+def restore_optimizer(learner, filename):
+    #Gradient descent state of a checkpoint saved with learner=, into a learner of the same network
+    header, arrays = read_checkpoint(filename)
+    if 'optimizer' not in header: return False
+    gd = learner.gd
+    for k, v in header['optimizer'].iteritems(): setattr(gd, k, v)
+    for k in optimizer_arrays:
+        if 'optimizer/' + k in arrays: setattr(gd, k, numpy.array(arrays['optimizer/' + k]))
+    if 'optimizer/values' in arrays: learner.network._setParameters(gd.values)
+    return True
+
+#Checkpoints while training, written by a background thread. On the training thread the parameters (and
+#optionally the optimizer state) are copied and the header is built, from a topology described once per
+#network; the file is written on the writer thread. Every `every` learn calls a periodic checkpoint is
+#written (the newest `keep` stay), and a best.brain whenever the score (reward collected since the last
+#learn call) is the best yet. When the writer falls behind checkpoints are dropped, never waited for; a
+#dropped best one does not count, the next score above the last written best is saved instead.
+class CheckpointWriter(object):
+    def __init__(self, directory, every = 10, keep = 5, optimizer = True, queue_size = 4, dtype = numpy.float64):
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        self.optimizer = optimizer
+        self.dtype = dtype
+        self.learns = 0
+        self.best = None
+        self.written = 0
+        self.dropped = 0
+        self.errors = []
+        self._descr = {}                                        #Topology per network, built once
+        self._periodic = collections.deque()
+        self._queue = Queue.Queue(queue_size)
+        self._thread = threading.Thread(target = self._run, name = 'CheckpointWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, team):
+        #After every Team.Learn
+        self.learns += 1
+        score = team.learn_stats['reward']
+        meta = {'learns': self.learns, 'score': score, 'dif': team.learn_stats['dif']}
+        if self.best == None or score > self.best:
+            if self.save(team, 'best', meta): self.best = score
+        if self.learns % self.every == 0: self.save(team, 'periodic', meta)
+
+    def save(self, team, kind, meta = None):                    #Returns False if the checkpoint had to be dropped
+        network = team.living.brain
+        if id(network) not in self._descr: self._descr[id(network)] = topology(network)
+        learner = team.agent.learner if self.optimizer else None
+        header, arrays = checkpoint_arrays(network, self.dtype, False, learner, meta, self._descr[id(network)])
+        try: self._queue.put_nowait((kind, header, arrays))
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job == None: return
+                self._write(*job)
+            except Exception, e: self.errors.append(e)          #Reported, the training goes on
+            finally: self._queue.task_done()
+    def _write(self, kind, header, arrays):
+        if kind == 'best': filename = os.path.join(self.directory, 'best.brain')
+        else: filename = os.path.join(self.directory, 'learn%06i.brain' % header['meta'].get('learns', self.written))
+        write_arrays(filename + '.tmp', header, arrays)
+        os.rename(filename + '.tmp', filename)                  #Never a half written checkpoint under the real name
+        self.written += 1
+        if kind == 'periodic' and filename not in self._periodic:
+            self._periodic.append(filename)
+            while len(self._periodic) > self.keep:
+                old = self._periodic.popleft()
+                if os.path.exists(old): os.remove(old)
+
+    def flush(self):                                            #Blocks until everything queued is on disk
+        self._queue.join()
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+def _load_pickle(filename):
+    import pickle
+    network = pickle.load(open(filename, 'rb'))
+    network.offset = 0                                  #Same repair the pickle loader always needed
+    for m in network.modulesSorted: m.offset = 0
+    return network
+
+def convert_pickle(filename, target = None, dtype = numpy.float64):
+    network = _load_pickle(filename)
+    if target == None: target = filename.rsplit('.', 1)[0] + '.brain'
+    save_checkpoint(network, target, dtype, meta = {'converted_from': filename})
+    return target
+
+def round_trip(network, steps = 10, seed = 0):
+    #Largest output difference between network and its checkpoint saved with state=True, both activated with
+    #the same inputs after `steps` activations of history. 0.0 if state and parameters survive the file
+    import tempfile
+    rng = numpy.random.RandomState(seed)
+    inputs = rng.uniform(-1., 1., (2*steps, network.indim))
+    network.reset()
+    for x in inputs[:steps]: network.activate(x)
+    fd, filename = tempfile.mkstemp('.brain')
+    os.close(fd)
+    try:
+        save_checkpoint(network, filename, state = True)
+        loaded = load_checkpoint(filename)[0]
+    finally: os.remove(filename)
+    return max(numpy.abs(network.activate(x) - loaded.activate(x)).max() for x in inputs[steps:])
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3 or sys.argv[1] not in ('convert', 'check'):
+        print "usage: python checkpoint.py convert|check file.p [file.p ...]"
+        sys.exit(1)
+    if sys.argv[1] == 'convert':
+        for filename in sys.argv[2:]: print filename, "->", convert_pickle(filename)
+    else:
+        failed = False
+        for filename in sys.argv[2:]:
+            network = load_checkpoint(filename)[0] if is_checkpoint(filename) else _load_pickle(filename)
+            diff = round_trip(network)
+            print filename, "round trip difference: %g" % diff
+            failed = failed or diff != 0.
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,261 @@
+from collections import OrderedDict
+
+import numpy
+
+__author__ = 'AH'
+
+from pybrain.structure import LinearLayer, TanhLayer, SigmoidLayer, SoftmaxLayer, BiasUnit, LSTMLayer
+from pybrain.structure import FullConnection, IdentityConnection
+
+#Compiles a sorted pybrain network into a flat numpy kernel. The kernel keeps only the buffers of the
+#current and the previous timestep (enough for recurrent connections and LSTM state) and works on its
+#own copy of the parameters, which can be written back into the pybrain object with pushParams()
+
+LINEAR, TANH, SIGMOID, SOFTMAX, BIAS, LSTM = range(6)
+module_kinds = {LinearLayer: LINEAR, TanhLayer: TANH, SigmoidLayer: SIGMOID, SoftmaxLayer: SOFTMAX, BiasUnit: BIAS, LSTMLayer: LSTM}
+
+def param_layout(network):
+    #List of (container, offset, length) of everything holding parameters, in the order of network.params
+    layout = []
+    offset = 0
+    for c in network._containerIterator():
+        layout.append((c, offset, c.paramdim))
+        offset += c.paramdim
+    return layout
+
+def connection_views(network):
+    #(container, view onto network.params) for everything with parameters, in the order of params. Nothing
+    #is copied: every FullConnection is an (indim, outdim) matrix W with W[i, o] weighting input unit i for
+    #output unit o, other connections and modules with parameters (e.g. LSTM peepholes) are flat. The views
+    #stay valid until the network's params array is replaced, e.g. by _setParameters() in a learning step
+    params = network.params
+    views = []
+    for c, offset, length in param_layout(network):
+        if length == 0: continue
+        flat = params[offset:offset+length]
+        if type(c) == FullConnection: views.append((c, flat.reshape(c.outdim, c.indim).T))
+        else: views.append((c, flat))
+    return views
+
+def weight_views(network):
+    #connection_views keyed "in>out" for connections and by name otherwise
+    views = OrderedDict()
+    for c, view in connection_views(network):
+        key = "%s>%s" % (c.inmod.name, c.outmod.name) if hasattr(c, 'inmod') else c.name
+        if key in views: key = "%s (%s)" % (key, c.name)                 #e.g. a recurrent next to a forward connection
+        views[key] = view
+    return views
+
+def activation_views(network, row = None):
+    #Per module name the (input, output) rows of its buffers, views as well. By default the latest ones,
+    #a recurrent network's offset is past them after activate()
+    if row == None: row = max(network.offset - 1, 0)
+    views = OrderedDict()
+    for m in network.modulesSorted:
+        views[m.name] = tuple(buf[min(row, len(buf)-1)] for buf in (m.inputbuffer, m.outputbuffer))
+    return views
+
+def _sigmoid(x, out):
+    numpy.clip(-x, -500, 500, out)                      #Same bounds as pybrain's safeExp
+    numpy.exp(out, out)
+    out += 1.
+    numpy.divide(1., out, out)
+    return out
+
+class CompiledNetwork(object):
+    shape = ()                                                              #Leading dimensions of every buffer
+    
+    def __init__(self, network):
+        if not network.sorted: network.sortModules()
+        self.network = network
+        self.indim = network.indim
+        self.outdim = network.outdim
+        self.params = self._allocateParams(network)
+        self.offsets = dict((id(c), offset) for c, offset, _ in param_layout(network))
+
+        self.modules = list(network.modulesSorted)
+        index = dict((m, i) for i, m in enumerate(self.modules))
+        for m in self.modules:
+            if type(m) not in module_kinds: raise NotImplementedError("Cannot compile module %s" % m.__class__.__name__)
+        self.kinds = [module_kinds[type(m)] for m in self.modules]
+        self.inbufs = [self._buffer(m.indim) for m in self.modules]
+        self.outbufs = [self._buffer(m.outdim) for m in self.modules]
+        self.prevbufs = [self._buffer(m.outdim) for m in self.modules]       #Outputs of the last timestep
+        self.states = [self._buffer(m.outdim) if k == LSTM else None for m, k in zip(self.modules, self.kinds)]
+        self.peeps = [self._peepholes(m) if k == LSTM else None for m, k in zip(self.modules, self.kinds)]
+
+        self.conns = [[self._compileConnection(c, index, self.outbufs) for c in network.connections[m]] for m in self.modules]
+        self.recurrent = [self._compileConnection(c, index, self.prevbufs) for c in getattr(network, 'recurrentConns', [])]
+        self.inputs = self._slices([self.inbufs[index[m]] for m in network.inmodules])
+        self.outputs = self._slices([self.outbufs[index[m]] for m in network.outmodules])
+        self.outbuf = self._buffer(self.outdim)
+        self.t = 0
+
+    def _allocateParams(self, network):
+        return numpy.array(network.params, dtype=float)
+    def _buffer(self, dim):
+        return numpy.zeros(self.shape + (dim,))
+    def _slices(self, bufs):                                                #(buffer, flat slice) pairs of the in- or outmodules
+        pairs = []
+        index = 0
+        for b in bufs:
+            pairs.append((b, slice(index, index+b.shape[-1])))
+            index += b.shape[-1]
+        return pairs
+    def _weights(self, container, rows, cols):
+        offset = self.offsets[id(container)]
+        return self.params[..., offset:offset+rows*cols].reshape(self.params.shape[:-1] + (rows, cols))   #A view, follows pullParams()
+    def _peepholes(self, m):
+        if not m.peepholes: return None
+        dim = m.outdim
+        w = self._weights(m, 3, dim)
+        return w[..., 0, :], w[..., 1, :], w[..., 2, :]                     #ingate, forgetgate, outgate
+    def _compileConnection(self, c, index, sources):
+        #(weights, source view, target view, scratch), all views stay valid as the buffers are never reallocated
+        if type(c) == FullConnection: w = self._weights(c, c.outdim, c.indim)
+        elif type(c) == IdentityConnection: w = None
+        else: raise NotImplementedError("Cannot compile connection %s" % c.__class__.__name__)
+        src = sources[index[c.inmod]][..., c.inSliceFrom:c.inSliceTo]
+        dst = self.inbufs[index[c.outmod]][..., c.outSliceFrom:c.outSliceTo]
+        return (w, src, dst, numpy.empty(dst.shape))
+
+    def pullParams(self):                                                   #pybrain -> kernel
+        self.params[:] = self.network.params
+    def pushParams(self):                                                   #kernel -> pybrain
+        self.network.params[:] = self.params
+
+    def pullState(self):                                                    #Continue from where the pybrain object stands
+        self.reset()
+        offset = self.network.offset
+        if offset == 0: return
+        for i, m in enumerate(self.modules):
+            self.prevbufs[i][:] = m.outputbuffer[offset-1]
+            if self.states[i] is not None: self.states[i][:] = m.state[offset-1]
+        self.t = offset
+
+    def reset(self):
+        for b in self.prevbufs: b.fill(0.)
+        for s in self.states:
+            if s is not None: s.fill(0.)
+        self.t = 0
+
+    def _propagate(self, conn):
+        w, src, dst, tmp = conn
+        if w is None: dst += src
+        else: dst += numpy.dot(w, src, tmp)
+
+    def activate(self, inpt):
+        for b in self.inbufs: b.fill(0.)
+        for b, s in self.inputs: b[...] = inpt[..., s]
+        if self.t > 0:
+            for c in self.recurrent: self._propagate(c)
+
+        for i, kind in enumerate(self.kinds):
+            inbuf, outbuf = self.inbufs[i], self.outbufs[i]
+            if kind == LINEAR: outbuf[:] = inbuf
+            elif kind == TANH: numpy.tanh(inbuf, outbuf)
+            elif kind == SIGMOID: _sigmoid(inbuf, outbuf)
+            elif kind == BIAS: outbuf[:] = 1.
+            elif kind == SOFTMAX:
+                numpy.exp(numpy.clip(inbuf, -500, 500), outbuf)
+                outbuf /= outbuf.sum(-1)[..., None]
+            elif kind == LSTM: self._lstm(i, inbuf, outbuf)
+            for c in self.conns[i]: self._propagate(c)
+
+        for b, s in self.outputs: self.outbuf[..., s] = b
+        for prev, out in zip(self.prevbufs, self.outbufs): prev[...] = out
+        self.t += 1
+        return self.outbuf.copy()
+
+    def _lstm(self, i, inbuf, outbuf):
+        #Same gate layout as pybrain's LSTMLayer: ingate, forgetgate, cell input, outgate
+        state = self.states[i]
+        dim = state.shape[-1]
+        ingatex, forgetgatex = inbuf[..., :dim], inbuf[..., dim:dim*2]
+        cellx, outgatex = inbuf[..., dim*2:dim*3], inbuf[..., dim*3:]
+        peeps = self.peeps[i]
+        if peeps is not None and self.t > 0:
+            ingatex += peeps[0] * state
+            forgetgatex += peeps[1] * state
+        forgetgate = _sigmoid(forgetgatex, numpy.empty(state.shape))
+        state *= forgetgate                                                 #The previous state, zero after reset
+        state += _sigmoid(ingatex, numpy.empty(state.shape)) * numpy.tanh(cellx)
+        if peeps is not None: outgatex += peeps[2] * state
+        _sigmoid(outgatex, outbuf)
+        outbuf *= numpy.tanh(state)
+
+def compile_net(network):
+    return CompiledNetwork(network)
+
+def net_state(network):
+    #What the next activation depends on: the buffers of the last and the current timestep, or a kernel's state.
+    #The current row matters as pybrain accumulates into it, e.g. when ENAC's backward pass rewinds the offset
+    if isinstance(network, CompiledNetwork):
+        return (network.t, [b.copy() for b in network.prevbufs], [None if st is None else st.copy() for st in network.states])
+    offset = network.offset
+    rows = slice(max(offset-1, 0), offset+1)
+    return (offset, [[getattr(m, name)[rows].copy() for name, _ in m.bufferlist] for m in network.modulesSorted])
+
+def set_net_state(network, state):
+    if isinstance(network, CompiledNetwork):
+        network.t = state[0]
+        for b, saved in zip(network.prevbufs, state[1]): b[...] = saved
+        for st, saved in zip(network.states, state[2]):
+            if st is not None: st[...] = saved
+        return
+    #The older history is dropped, the saved timesteps become the first ones
+    network.reset()
+    offset, buffers = state
+    for m, saved in zip(network.modulesSorted, buffers):
+        while getattr(m, m.bufferlist[0][0]).shape[0] < len(saved[0]): m._growBuffers()
+        for (name, _), b in zip(m.bufferlist, saved): getattr(m, name)[:len(b)] = b
+    network.offset = min(offset, 1)
+    while network.inputbuffer.shape[0] <= network.offset: network._growBuffers()     #The network's own buffers too
+
+#Many brains of the same topology activated at once. Parameters are stacked to (n_brains, paramdim),
+#so every FullConnection becomes a (n_brains, outdim, indim) tensor view onto them. Every brain can drive
+#several agents: buffers are (n_brains, n_agents, dim) and each connection is one batched matmul
+class PopulationNetwork(CompiledNetwork):
+    def __init__(self, network, n_brains, n_agents = 1):
+        self.shape = (n_brains, n_agents)
+        CompiledNetwork.__init__(self, network)
+    @classmethod
+    def fromNetworks(cls, networks, n_agents = 1):                          #Networks must share the topology of the first
+        population = cls(networks[0], len(networks), n_agents)
+        for k, n in enumerate(networks): population.params[k] = n.params
+        return population
+
+    def _allocateParams(self, network):
+        return numpy.tile(numpy.asarray(network.params, dtype=float), (self.shape[0], 1))
+    @property
+    def n_brains(self):
+        return self.shape[0]
+    @property
+    def n_agents(self):
+        return self.shape[1]
+
+    def _peepholes(self, m):
+        peeps = CompiledNetwork._peepholes(self, m)
+        if peeps == None: return None
+        return tuple(w[:, None, :] for w in peeps)                          #Broadcast over the agents
+    def _propagate(self, conn):
+        w, src, dst, tmp = conn
+        if w is None: dst += src
+        else: dst += numpy.matmul(src, w.transpose(0, 2, 1), tmp)
+
+    def pullParams(self, k = None, network = None):                          #pybrain -> row k (all rows without k)
+        if network == None: network = self.network
+        if k == None: self.params[:] = network.params
+        else: self.params[k] = network.params
+    def pushParams(self, k, network = None):                                 #row k -> pybrain
+        if network == None: network = self.network
+        network.params[:] = self.params[k]
+    def pullState(self):
+        raise NotImplementedError("A population has no single pybrain object to take the state from")
+
+    def activate(self, inpt):
+        #inpt is (n_brains, n_agents, indim), or (n_brains, indim) with one agent per brain
+        inpt = numpy.asarray(inpt)
+        out = CompiledNetwork.activate(self, inpt.reshape(self.shape + (self.indim,)))
+        if inpt.ndim == 2: return out.reshape(self.n_brains, self.outdim)
+        return out
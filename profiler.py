@@ -0,0 +1,81 @@
+import json
+import time
+
+import numpy
+
+from textcache import text_cache
+
+__author__ = 'AH'
+
+#Wall time per stage and tick. Instrumented code adds the seconds it spent to a stage (stages of one tick
+#accumulate, e.g. every Eater's update), tick() closes the tick: every stage's total goes into a ring of the
+#last `window` ticks for the rolling percentiles and is optionally streamed to a file.
+#Streams ending with .jsonl get one object per tick, anything else is CSV with one row per tick and stage.
+#Stages may be nested, e.g. 'sensors' is part of 'update:Eater'. Offscreen video frames count as 'video'.
+
+class TickProfiler(object):
+    clock = staticmethod(time.time)
+
+    def __init__(self, window = 300, stream = None):
+        self.window = window
+        self.ticks = 0
+        self.current = {}
+        self.history = {}                                   #stage -> ring of seconds
+        self.order = []                                     #Stages in the order they first appeared
+        self.stream = None
+        self.jsonl = False
+        if stream != None: self.open(stream)
+
+    def open(self, filename):
+        self.close()
+        self.jsonl = filename.endswith('.jsonl')
+        self.stream = open(filename, 'w')
+        if not self.jsonl: self.stream.write("tick,stage,ms\n")
+    def close(self):
+        if self.stream != None: self.stream.close()
+        self.stream = None
+
+    def add(self, stage, seconds):
+        self.current[stage] = self.current.get(stage, 0.) + seconds
+    def since(self, stage, start):                          #Adds the time since start, returns now for chaining
+        now = self.clock()
+        self.current[stage] = self.current.get(stage, 0.) + now - start
+        return now
+
+    def tick(self):
+        slot = self.ticks % self.window
+        for stage, seconds in self.current.iteritems():
+            if stage not in self.history:
+                self.history[stage] = numpy.zeros(self.window)
+                self.order.append(stage)
+            self.history[stage][slot] = seconds
+        for stage in self.order:                            #A stage that did not run this tick took no time
+            if stage not in self.current: self.history[stage][slot] = 0.
+        if self.stream != None: self._write()
+        self.current = {}
+        self.ticks += 1
+    def _write(self):
+        if self.jsonl:
+            row = dict((stage, seconds*1000.) for stage, seconds in self.current.iteritems())
+            row['tick'] = self.ticks
+            self.stream.write(json.dumps(row) + "\n")
+        else:
+            for stage in self.order:
+                if stage in self.current: self.stream.write("%i,%s,%.4f\n" % (self.ticks, stage, self.current[stage]*1000.))
+
+    def percentiles(self, stage, q = (50, 95, 99)):         #In seconds, over the filled part of the window
+        ring = self.history[stage][:min(self.ticks, self.window)]
+        if len(ring) == 0: return [0.]*len(q)
+        return numpy.percentile(ring, q)
+    def summary(self):
+        return [(stage, self.percentiles(stage)) for stage in self.order]
+
+    def draw(self, surface, font, x, y, color = (255,255,255), background = (0,0,0)):
+        #Overlay with p50/p95/p99 in ms per stage
+        lines = ["%-16s %7s %7s %7s" % ("stage", "p50", "p95", "p99")]
+        for stage, (p50, p95, p99) in self.summary():
+            lines.append("%-16s %7.2f %7.2f %7.2f" % (stage[:16], p50*1000., p95*1000., p99*1000.))
+        for line in lines:
+            srf = text_cache.render(font, line, color, 1.0, background)
+            surface.blit(srf, (x, y))
+            y += srf.get_height()
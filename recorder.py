@@ -0,0 +1,108 @@
+import json
+import os
+
+import numpy
+
+__author__ = 'AH'
+
+#Trajectories of one living as raw, memory-mapped arrays in a directory, one file per field:
+#   obs (inbuf), action (outbuf), reward, done, body (x, y, vx, vy, angle, angular velocity)
+#plus index.json with the dims, the number of samples and where every episode starts (rewritten at episode
+#ends and every `index_every` samples, so a killed run stays readable up to there). Files grow by
+#doubling (truncate and map again, nothing is copied), a sample costs a few row assignments.
+#load_trajectories() maps everything read-only, e.g. for offline learning or replays.
+
+BODY_FIELDS = 6
+
+class TrajectoryRecorder(object):
+    index_every = 1024
+    
+    def __init__(self, directory, indim, outdim, capacity = 4096, meta = None):
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.directory = directory
+        self.meta = meta or {}                                  #Whatever is needed to rebuild the run, e.g. the seed
+        self.fields = {'obs': (indim, 'f8'), 'action': (outdim, 'f8'), 'reward': (1, 'f8'), 'done': (1, 'u1'),
+                       'body': (BODY_FIELDS, 'f8')}
+        self.length = 0
+        self.capacity = 0
+        self.episodes = [0]                                     #Start of every episode
+        self.arrays = {}                                        #The memmaps
+        self.views = {}                                         #Plain ndarrays onto them, much cheaper to index
+        self._grow(capacity)
+
+    @classmethod
+    def forLiving(cls, directory, living, capacity = 4096, meta = None):
+        return cls(directory, living.indim, living.outdim, capacity, meta)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.bin')
+    def _grow(self, capacity):
+        for name, (dim, dtype) in self.fields.iteritems():
+            if name in self.arrays: self.arrays[name].flush()
+            size = capacity * dim * numpy.dtype(dtype).itemsize
+            f = open(self._path(name), 'r+b' if self.capacity else 'w+b')             #A new recorder starts over
+            f.truncate(size)
+            f.close()
+            self.arrays[name] = numpy.memmap(self._path(name), dtype, 'r+', 0, (capacity, dim))
+            self.views[name] = self.arrays[name].view(numpy.ndarray)
+        self._obs, self._action, self._reward, self._done, self._body = [self.views[name][:, 0] if self.fields[name][0] == 1
+            else self.views[name] for name in ('obs', 'action', 'reward', 'done', 'body')]
+        self.capacity = capacity
+
+    def record(self, obs, action, reward, done, body = None):
+        i = self.length
+        if i == self.capacity: self._grow(self.capacity * 2)
+        self._obs[i] = obs
+        self._action[i] = action
+        self._reward[i] = reward
+        self._done[i] = done
+        if body != None:
+            p, v = body.position, body.velocity
+            self._body[i] = (p.x, p.y, v.x, v.y, body.angle, body.angular_velocity)
+        self.length = i + 1
+        if done: self.newEpisode()
+        elif self.length % self.index_every == 0: self.writeIndex()
+    def recordTeam(self, team, finished):                      #After Team.Interaction: what it saw and did
+        living = team.living
+        self.record(living.inbuf, living.outbuf, team.last_reward, finished, getattr(living, 'body', None))
+
+    def newEpisode(self):
+        if self.episodes[-1] == self.length: return             #Nothing recorded since the last start
+        self.episodes.append(self.length)
+        self.writeIndex()
+
+    def writeIndex(self):
+        index = {'length': self.length, 'episodes': [e for e in self.episodes if e < self.length] or [0], 'meta': self.meta,
+                 'fields': dict((name, [dim, dtype]) for name, (dim, dtype) in self.fields.iteritems())}
+        f = open(os.path.join(self.directory, 'index.json.tmp'), 'w')
+        json.dump(index, f)
+        f.close()
+        os.rename(os.path.join(self.directory, 'index.json.tmp'), os.path.join(self.directory, 'index.json'))
+    def flush(self):
+        for a in self.arrays.itervalues(): a.flush()
+        self.writeIndex()
+    def close(self):
+        self.flush()
+        self.arrays, self.views = {}, {}
+
+class Trajectories(object):
+    #Read-only view of a recorder's directory: fields as (length, dim) memmaps, episodes as slices
+    def __init__(self, directory):
+        index = json.load(open(os.path.join(directory, 'index.json')))
+        self.length = index['length']
+        self.starts = index['episodes']
+        self.meta = index.get('meta', {})
+        self.arrays = {}
+        for name, (dim, dtype) in index['fields'].iteritems():
+            if self.length == 0: self.arrays[name] = numpy.zeros((0, dim), dtype)
+            else: self.arrays[name] = numpy.memmap(os.path.join(directory, name + '.bin'), dtype, 'r', 0, (self.length, dim))
+    def __getitem__(self, name):
+        return self.arrays[name]
+    def __len__(self):
+        return len(self.starts)
+    def episode(self, k):                                       #Dict of zero-copy slices of the k-th episode
+        end = self.starts[k+1] if k+1 < len(self.starts) else self.length
+        return dict((name, a[self.starts[k]:end]) for name, a in self.arrays.iteritems())
+
+def load_trajectories(directory):
+    return Trajectories(directory)
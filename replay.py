@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import os
+
+import numpy
+
+__author__ = 'AH'
+
+#Deterministic replay of a recorded run (test.py --record DIR). The scenario is rebuilt from the recorded
+#seed and the recorded actions are fed through TaskLiving.performAction, while the world goes on exactly
+#like in the main loop: respawns, food, time steps. No brain is involved, it runs headless at full speed.
+#Every step the observation, body state, reward and done flag are compared with the recording and the
+#first divergence is reported. Selected steps can be rendered to PNG files.
+#Manual interference while recording (arrow keys, F7, F8) is not in the recording and shows up as divergence.
+#Chipmunk orders colliding shapes by their memory address, so like a seeded test.py the replay runs without
+#address space randomization (seeding.fixed_address_space). The recording process learned as well and so
+#allocated differently. Recordings replayed exactly in tests (175000 steps), but that is not guaranteed,
+#and without a fixed address space a replay can part after a few steps.
+#Only the eater is recorded. Food, the ball and the world's random stream are rebuilt, not restored, so a
+#difference there goes unnoticed until it reaches the eater, often only at the next episode start: the
+#respawn point and new food come from the same random stream, and feed_cage draws again for every spot
+#that is taken, i.e. as often as the food lying around decides. Divergences from an episode start on are
+#reported as such. With resync the eater is put back onto the recorded body state after a divergence, so
+#a long replay still reaches the situation of interest, but the rest of the world stays as replayed.
+#Differences up to the tolerance are float noise, not divergence.
+#
+#   python -O replay.py runs/traj [--frames 100,200,300-320 --out frames] [--tolerance 1e-9] [--resync]
+
+class Divergence(object):
+    def __init__(self, step, field, expected, actual):
+        self.step = step
+        self.field = field
+        diff = numpy.abs(numpy.asarray(expected, dtype=float) - numpy.asarray(actual, dtype=float)).ravel()
+        self.index = int(diff.argmax())
+        self.max_diff = float(diff.max())
+        self.expected = numpy.asarray(expected).ravel()[self.index]
+        self.actual = numpy.asarray(actual).ravel()[self.index]
+    def __str__(self):
+        return "step %i: %s[%i] is %r, recorded %r (max difference %g)" % (self.step, self.field, self.index,
+                                                                           self.actual, self.expected, self.max_diff)
+
+def _body_row(body):
+    p, v = body.position, body.velocity
+    return (p.x, p.y, v.x, v.y, body.angle, body.angular_velocity)
+
+def _set_body(body, row):
+    body.position = row[0], row[1]
+    body.velocity = row[2], row[3]
+    body.angle = row[4]
+    body.angular_velocity = row[5]
+
+def replay(directory, frames = (), out = None, tolerance = 1e-9, stop = True, steps = None, resync = False):
+    #Returns (replayed steps, list of divergences). With stop, replaying ends at the first divergence
+    from recorder import load_trajectories
+    from test import build_eat_scenario, eat_episode_over, respawn_eater, feed_cage
+    from seeding import RandomStreams
+
+    trajectories = load_trajectories(directory)
+    meta = trajectories.meta
+    if meta.get('scenario') != 'eat': raise ValueError("Cannot replay scenario %r" % meta.get('scenario'))
+    frames = set(frames)
+    surface = None
+    if frames:
+        import pygame
+        surface = pygame.Surface((800, 600))
+        if out != None and not os.path.isdir(out): os.makedirs(out)
+    cage_env, eater, task = build_eat_scenario(surface, RandomStreams(meta['seed']))
+    cage_env.rendering = False
+    dt = 1./meta['fps']
+    obs, actions, rewards, dones, bodies = [trajectories[f] for f in ('obs', 'action', 'reward', 'done', 'body')]
+    n = trajectories.length if steps == None else min(steps, trajectories.length)
+
+    divergences = []
+    time = 0
+    for step in range(n):
+        #The same order as the main loop: Team.Interaction, respawn, food, time step
+        found = []
+        if not numpy.allclose(eater.inbuf, obs[step], 0., tolerance): found.append(Divergence(step, 'obs', obs[step], eater.inbuf))
+        body = _body_row(eater.body)
+        if not numpy.allclose(body, bodies[step], 0., tolerance):
+            found.append(Divergence(step, 'body', bodies[step], body))
+            if resync and not stop:
+                _set_body(eater.body, bodies[step])
+                cage_env.space.reindex_shape(eater.shape)
+        task.performAction(numpy.array(actions[step]))
+        reward = task.getReward()
+        if abs(reward - rewards[step, 0]) > tolerance: found.append(Divergence(step, 'reward', rewards[step], [reward]))
+        finished = task.isFinished()
+        if finished != bool(dones[step, 0]): found.append(Divergence(step, 'done', dones[step], [finished]))
+        if finished: task.reset()
+        divergences.extend(found)
+        if found and stop: return step, divergences
+
+        if eat_episode_over(eater, time):
+            respawn_eater(cage_env, eater)
+            task.reset()
+            time = 0
+        if (step%40 >= 40-1): feed_cage(task.food_pool)
+
+        cage_env.rendering = step in frames
+        cage_env.processTimeStep(dt)
+        if cage_env.rendering:
+            import pygame
+            cage_env.drawThings()
+            if out != None: pygame.image.save(surface, os.path.join(out, 'frame%06i.png' % step))
+            surface.fill((0, 0, 0))
+        time += dt
+    return n, divergences
+
+def parse_frames(text):                                 #"100,200,300-320"
+    frames = []
+    for part in text.split(','):
+        if '-' in part:
+            a, b = part.split('-')
+            frames.extend(range(int(a), int(b)+1))
+        elif part: frames.append(int(part))
+    return frames
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = "Replay a recorded run and check it for divergence",
+                                     epilog = "Only the eater is recorded: food and the world's random stream are rebuilt, so a "
+                                              "difference there shows only where it reaches the eater, often at the next episode start.")
+    parser.add_argument('directory')
+    parser.add_argument('--frames', type = parse_frames, default = [], help = "steps to render, e.g. 100,200,300-320")
+    parser.add_argument('--out', default = 'frames', help = "directory for the rendered frames")
+    parser.add_argument('--tolerance', type = float, default = 1e-9)
+    parser.add_argument('--steps', type = int, help = "replay only this many steps")
+    parser.add_argument('--all', action = 'store_true', help = "go on after a divergence and report every one")
+    parser.add_argument('--resync', action = 'store_true', help = "like --all, and put the eater back onto the recorded track")
+    args = parser.parse_args()
+    from seeding import fixed_address_space
+    fixed_address_space()                               #The recording's process ran without randomization, too
+
+    n, divergences = replay(args.directory, args.frames, args.out, args.tolerance, not (args.all or args.resync), args.steps, args.resync)
+    if not divergences: print "%i steps replayed, no divergence" % n
+    else:
+        print "%i steps replayed, %i divergences in %i steps, the first:" % (n, len(divergences), len(set(d.step for d in divergences)))
+        print "   ", divergences[0]
+        from recorder import load_trajectories
+        starts = load_trajectories(args.directory).starts
+        if divergences[0].step in starts:
+            print "    at an episode start: the respawn point or food differ, the world parted earlier than the eater shows"
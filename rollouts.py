@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import pickle
+
+import numpy
+
+from seeding import RandomStreams, seed_everything, randomize_net, fixed_address_space
+
+__author__ = 'AH'
+
+#Episode rollouts in a pool of worker processes. Every worker owns its own CageEnvironment, Eater and
+#Team, receives the parameters of the learner's network (brain and exploration) and sends back per
+#episode observations, actions, rewards and the log likelihood derivatives the ENAC learner regresses on.
+#Every episode is a job of its own: it starts from the worker's initial cage (a snapshot) with its own
+#streams for the world and for exploration, so the rollouts of a seeded runner do not depend on the number
+#of workers or on which worker runs which episode.
+
+_worker = {}
+
+def _init_worker(brain_pickle, fps):
+    from test import build_cage, Team
+    from pybrain.rl.learners import ENAC
+    from cage import TaskEat
+
+    cage_env, eater, _, food_pool = build_cage(None)
+    eater.brain = pickle.loads(brain_pickle)
+    eater.brain.offset = 0                                          #Same repair as load_net
+    for m in eater.brain.modulesSorted: m.offset = 0
+    task = TaskEat(cage_env, eater, food_pool)
+    team = Team(eater, task, ENAC(), numpy.random.RandomState())    #Reseeded by every episode
+    _worker.update(cage_env = cage_env, eater = eater, task = task, team = team, dt = 1./fps, start = cage_env.snapshot())
+
+def _run_episode(args):
+    from test import feed_cage
+    params, max_samples, env_seed, explore_seed = args
+    cage_env, eater, task, team, dt = [_worker[k] for k in ('cage_env', 'eater', 'task', 'team', 'dt')]
+    agent = team.agent
+    agent.learner.network._setParameters(params.copy())
+    cage_env.restore(_worker['start'], True)                        #Nothing of the previous episode remains
+    cage_env.random.seed(env_seed)
+    agent.learner.explorer.rng.seed(explore_seed)
+
+    agent.reset()
+    agent.learner.network.derivs.fill(0.)                           #pybrain accumulates the loglh rows from here on (its
+                                                                    #resetDerivatives multiplies by 0 and keeps the signs of zeros)
+    task.reset()
+    eater.respawn((cage_env.random.random_sample()*40-20, 2))
+    for step in range(max_samples):
+        _, finished = team.Interaction()
+        if step % 40 >= 40-1: feed_cage(task.food_pool)
+        cage_env.processTimeStep(dt)
+        if finished or eater.energy <= 0.: break
+    history = agent.history
+    rollout = (history.getField('state').copy(), history.getField('action').copy(),
+               history.getField('reward').copy(), agent.learner.loglh.getField('loglh').copy())
+    agent.reset()
+    return rollout
+
+def feed_rollouts(team, rollouts):
+    #Hand collected episodes to the team's agent as if they were its own history
+    agent = team.agent
+    agent.reset()
+    for states, actions, rewards, loglh in rollouts:
+        if len(states) == 0: continue
+        agent.history.newSequence()
+        for s, a, r in zip(states, actions, rewards): agent.history.addSample(s, a, r)
+        for l in loglh: agent.learner.loglh.appendLinked(l)
+
+class RolloutRunner(object):
+    def __init__(self, brain, workers = None, max_samples = 900, fps = 30, streams = None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_samples = max_samples                             #Per episode, 30s at 30 fps
+        self.streams = streams or RandomStreams()                  #A seeding.RandomStreams, the episodes' seeds derive from it
+        self.batches = 0
+        self.pool = multiprocessing.Pool(self.workers, _init_worker, (pickle.dumps(brain), fps))
+
+    def collect(self, team, episodes):
+        params = team.agent.learner.network.params.copy()
+        b = self.batches
+        jobs = [(params, self.max_samples, self.streams.seed('rollout env', b, e), self.streams.seed('rollout explore', b, e))
+                for e in range(episodes)]
+        self.batches += 1
+        chunk = max(1, -(-episodes // self.workers))
+        return self.pool.map(_run_episode, jobs, chunk)
+
+    def train(self, team, episodes):                               #Collect in parallel, learn once on everything
+        rollouts = self.collect(team, episodes)
+        feed_rollouts(team, rollouts)
+        dif = team.Learn()
+        return dif, rollouts
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 3: fixed_address_space()                    #Same seed, same rollouts, see seeding.py
+    from test import build_cage, load_net, Team
+    from pybrain.rl.learners import ENAC
+    from cage import TaskEat
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    episodes = int(sys.argv[2]) if len(sys.argv) > 2 else workers*2
+    streams = seed_everything(int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    print "seed: %i" % streams.root
+
+    cage_env, eater, _, food_pool = build_cage(None, seed = streams.seed('env', 0))
+    eater.brain = load_net("Eat_first_attempt.p")
+    randomize_net(eater.brain, streams.stream('brain'))
+    task = TaskEat(cage_env, eater, food_pool)
+    team = Team(eater, task, ENAC(), streams.stream('explore', 0))
+
+    runner = RolloutRunner(eater.brain, workers, streams = streams)
+    try:
+        while True:
+            dif, rollouts = runner.train(team, episodes)
+            print "episodes: %i  samples: %i  - brain dif: %3.8f  - mean return: %.1f" % (len(rollouts),
+                sum(len(r[0]) for r in rollouts), dif, numpy.mean([r[2].sum() for r in rollouts]))
+    finally:
+        runner.close()
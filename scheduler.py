@@ -0,0 +1,63 @@
+import time
+
+__author__ = 'AH'
+
+#Fixed timestep simulation decoupled from rendering. The simulation always advances by `timestep`, the
+#accumulator tracks how far the wall clock (times `speed`) is ahead of it. When paced, tick() sleeps whenever
+#the simulation gets ahead, so a speed of 10 gives ten substeps per rendered frame at 30 fps. When unlimited,
+#ticks run as fast as they can. Either way a frame is due once per wall clock frame interval.
+#
+#   while looping:
+#       frame = scheduler.frameDue()
+#       ... one tick with timestep, draw only if frame ...
+#       if frame: scheduler.frameDone()
+#       scheduler.tick()
+
+class FixedStepScheduler(object):
+    clock = staticmethod(time.time)
+
+    def __init__(self, timestep = 1./30, fps = 30., speed = 1., unlimited = False, max_lag = 0.25):
+        self.timestep = timestep
+        self.frame_interval = 1./fps
+        self.speed = speed                          #Simulated seconds per wall clock second when paced
+        self.unlimited = unlimited
+        self.max_lag = max_lag                      #Backlog in wall clock seconds that is given up on, not caught up
+        self.frame_substeps = 0                     #Ticks between the last two frames
+        self.frame_time = 0.                        #Wall clock time between them
+        self.reset()
+
+    def reset(self):
+        now = self.clock()
+        self.accumulator = 0.
+        self.last = now
+        self.next_frame = now
+        self.last_frame = now
+        self.substeps = 0
+    def setUnlimited(self, unlimited):
+        self.unlimited = unlimited
+        self.reset()
+
+    def tick(self):
+        #Once per simulated timestep
+        self.substeps += 1
+        if self.unlimited: return
+        now = self.clock()
+        self.accumulator += (now - self.last) * self.speed - self.timestep
+        self.last = now
+        if self.accumulator < 0.: time.sleep(-self.accumulator / self.speed)     #Counted in the next tick
+        elif self.accumulator > self.max_lag * self.speed: self.accumulator = self.max_lag * self.speed
+
+    def frameDue(self):
+        return self.clock() >= self.next_frame
+    def frameDone(self):
+        now = self.clock()
+        self.next_frame = max(self.next_frame + self.frame_interval, now)      #Do not render bursts after a stall
+        self.frame_time = now - self.last_frame
+        self.last_frame = now
+        self.frame_substeps = self.substeps
+        self.substeps = 0
+
+    @property
+    def tick_rate(self):                            #Ticks per wall clock second over the last frame
+        if self.frame_time <= 0.: return 0.
+        return self.frame_substeps / self.frame_time
@@ -0,0 +1,112 @@
+import ctypes
+import hashlib
+import os
+import random
+import sys
+
+import numpy
+
+from pybrain.rl.explorers.continuous.normal import NormalExplorer
+from pybrain.tools.functions import expln
+
+__author__ = 'AH'
+
+#One seed for a whole run. Everything that draws random numbers gets a stream of its own, derived from the
+#run's seed and a name (and index) by hashing, so the streams are independent of each other and of the order
+#they are asked for: a fourth cage does not change what the first three see, an episode of a rollout does not
+#depend on which worker process runs it.
+#
+#   streams = seed_everything(1234)
+#   cage_env = CageEnvironment(..., seed = streams.seed('env', k))    #Food, respawns
+#   randomize_net(brain, streams.stream('brain'))                       #Initial weights
+#   Team(eater, task, ENAC(), streams.stream('explore', k))             #Exploration noise
+#
+#pybrain and scipy draw from the global numpy.random, seed_everything seeds it (and random) as well, for
+#whatever has no stream of its own, e.g. the default brain of an Eater.
+#Chipmunk keeps its contacts in hash sets keyed by addresses, so with address space layout randomization
+#two processes with the same seed still go separate ways after a few hundred steps. fixed_address_space()
+#turns it off for the process (Linux) by executing it anew, the scripts do that only when given a seed.
+#Forked workers share their parent's layout anyway.
+
+def derive_seed(root, *keys):
+    #Four 32 bit words for RandomState, from the root seed and the keys
+    digest = hashlib.sha256(repr((root,) + keys)).digest()
+    return numpy.frombuffer(digest[:16], dtype='<u4').copy()
+
+class RandomStreams(object):
+    def __init__(self, root = None):
+        if root == None: root = random.SystemRandom().randint(0, 2**31-1)     #Still a run that can be repeated
+        self.root = int(root)
+    def seed(self, *keys):
+        return derive_seed(self.root, *keys)
+    def stream(self, *keys):
+        return numpy.random.RandomState(self.seed(*keys))
+
+def seed_everything(seed = None):
+    streams = RandomStreams(seed)
+    random.seed(streams.root)
+    numpy.random.seed(derive_seed(streams.root, 'global'))
+    return streams
+
+def randomize_net(network, rng):
+    #network.randomize() with a stream instead of the global numpy.random
+    network._params[:] = rng.randn(network.paramdim) * network.stdParams
+    if network.hasDerivatives: network.resetDerivatives()
+
+class SeededNormalExplorer(NormalExplorer):
+    #NormalExplorer drawing its noise from rng
+    def __init__(self, dim, sigma = 0., rng = None):
+        NormalExplorer.__init__(self, dim, sigma)
+        self.rng = rng if rng != None else numpy.random.RandomState()
+    def _forwardImplementation(self, inbuf, outbuf):
+        outbuf[:] = self.rng.normal(inbuf, expln(self.sigma))
+
+def seed_explorer(learner, rng):
+    #Replaces a policy gradient learner's explorer by a seeded one with the same sigma. The learner's
+    #network and gradient descent are built anew, so this is done before learning starts
+    old = learner.explorer
+    if isinstance(old, SeededNormalExplorer):
+        old.rng = rng
+        return old
+    explorer = SeededNormalExplorer(old.dim, rng = rng)
+    explorer.sigma = numpy.array(old.sigma, dtype=float)
+    learner.explorer = explorer
+    return explorer
+
+ADDR_NO_RANDOMIZE = 0x0040000
+
+_flag_options = (('debug', '-d'), ('py3k_warning', '-3'), ('inspect', '-i'), ('optimize', '-O'), ('dont_write_bytecode', '-B'),
+                 ('no_user_site', '-s'), ('no_site', '-S'), ('ignore_environment', '-E'), ('tabcheck', '-t'), ('verbose', '-v'),
+                 ('unicode', '-U'), ('bytes_warning', '-b'), ('hash_randomization', '-R'))
+
+def interpreter_args():
+    #The command line the interpreter was started with, after the executable. /proc has it as it was (-u, -W,
+    #-m pdb, ...), elsewhere it is pieced together from sys.flags and sys.warnoptions, which do not know -u
+    try:
+        f = open('/proc/self/cmdline', 'rb')
+        try: args = f.read().split('\0')[:-1]
+        finally: f.close()
+        if len(args) > 1: return args[1:]
+    except IOError: pass
+    flags = sys.flags
+    args = []
+    for name, option in _flag_options: args += [option] * getattr(flags, name, 0)
+    if flags.division_warning: args.append('-Qwarnall' if flags.division_warning > 1 else '-Qwarn')
+    if flags.division_new: args.append('-Qnew')
+    for w in sys.warnoptions: args += ['-W', w]
+    return args + sys.argv
+
+def fixed_address_space():
+    #Re-executes the process once without address space randomization. True if it runs without, False
+    #where that is not possible; call it before anything else happens
+    if not sys.platform.startswith('linux'): return False
+    try: libc = ctypes.CDLL(None)
+    except OSError: return False
+    persona = libc.personality(0xffffffff)                     #Only queries
+    if persona == -1: return False
+    if persona & ADDR_NO_RANDOMIZE: return True
+    if os.environ.get('AAT_FIXED_ADDRESSES'): return False      #Did not stick, do not loop
+    if libc.personality(persona | ADDR_NO_RANDOMIZE) == -1: return False
+    os.environ['AAT_FIXED_ADDRESSES'] = '1'
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable] + interpreter_args())
@@ -0,0 +1,83 @@
+import numpy
+
+__author__ = 'AH'
+
+#Uniform grid over the positions of things, for "what is near" questions without the pymunk space or a scan
+#of all things. The cells are packed into int64 keys and the things sorted by them, so the things of a row of
+#cells are one slice found by binary search. The grid is rebuilt lazily: whoever moves or adds things calls
+#invalidate() (CageEnvironment does in every time step), the next query asks `source` for the things again.
+#A query costs a binary search per column of cells it covers plus the candidates in there.
+
+_ROW = 2**32                                            #Packs (ix, iy) into ix*_ROW + iy + _ROW/2
+
+class SpatialGrid(object):
+    def __init__(self, cell = 2., source = None):
+        self.cell = float(cell)
+        self.source = source                            #Returns the things to index, each with a body
+        self.things = []
+        self.positions = numpy.zeros((0, 2))            #In the order of things, e.g. for analytics
+        self.stale = True
+        self.rebuilds = 0
+
+    def invalidate(self):
+        self.stale = True
+    def rebuild(self, things = None):
+        if things == None: things = self.source()
+        self.things = list(things)
+        n = len(self.things)
+        pos = numpy.empty((n, 2))
+        for i, th in enumerate(self.things):
+            p = th.body.position
+            pos[i, 0], pos[i, 1] = p.x, p.y
+        self.positions = pos
+        keys = self._keys(numpy.floor(pos / self.cell).astype(numpy.int64))
+        self.order = numpy.argsort(keys, kind = 'mergesort')
+        self.keys = keys[self.order]
+        if n: self.low, self.high = pos.min(0), pos.max(0)
+        self.stale = False
+        self.rebuilds += 1
+    def _keys(self, cells):
+        return cells[..., 0] * _ROW + cells[..., 1] + _ROW/2
+    def _fresh(self):
+        if self.stale: self.rebuild()
+
+    def _candidates(self, x, y, radius):
+        c = self.cell
+        ix = numpy.arange(int(numpy.floor((x - radius) / c)), int(numpy.floor((x + radius) / c)) + 1, dtype = numpy.int64)
+        iy0, iy1 = int(numpy.floor((y - radius) / c)), int(numpy.floor((y + radius) / c))
+        lo = numpy.searchsorted(self.keys, ix * _ROW + iy0 + _ROW/2, 'left')
+        hi = numpy.searchsorted(self.keys, ix * _ROW + iy1 + _ROW/2, 'right')
+        slices = [self.order[a:b] for a, b in zip(lo, hi) if b > a]
+        if not slices: return numpy.zeros(0, dtype = int)
+        return numpy.concatenate(slices)
+
+    def within(self, point, radius, cls = None, exclude = None):
+        #[(distance, thing)] within radius of point, nearest first, optionally only instances of cls
+        self._fresh()
+        if not self.things: return []
+        x, y = point[0], point[1]
+        idx = self._candidates(x, y, radius)
+        d = numpy.hypot(self.positions[idx, 0] - x, self.positions[idx, 1] - y)
+        keep = d <= radius
+        idx, d = idx[keep], d[keep]
+        s = numpy.argsort(d, kind = 'mergesort')
+        things = self.things
+        return [(d[i], things[idx[i]]) for i in s if (cls == None or isinstance(things[idx[i]], cls)) and things[idx[i]] is not exclude]
+
+    def nearest(self, point, k = 1, cls = None, exclude = None, max_radius = None):
+        #Up to k [(distance, thing)], nearest first. The search radius doubles until k are found or it
+        #covers every thing (or max_radius)
+        self._fresh()
+        if not self.things: return []
+        x, y = point[0], point[1]
+        reach = max(abs(x - self.low[0]), abs(x - self.high[0]), abs(y - self.low[1]), abs(y - self.high[1])) * 1.5
+        if max_radius != None: reach = min(reach, max_radius)
+        radius = min(self.cell, reach)
+        while True:
+            found = self.within(point, radius, cls, exclude)
+            if len(found) >= k or radius >= reach: return found[:k]
+            radius = min(radius * 2., reach)
+
+    def isClear(self, point, clearance, exclude = None):
+        #Nothing indexed within clearance of point
+        return not self.within(point, clearance, exclude = exclude)
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
+import weakref
+
+import numpy
 import pygame
 from pygame.locals import *
 
 import pyconsole
+from textcache import text_cache, format_number
 
 import pylab as pl
 
@@ -19,6 +23,8 @@ class World:
         self.drawing = True             # Only then all the continous drawing and flipping is performed
         self.draw_frame_time = True     # Draw Timesteps into window?
         self.last_delta_time = 0        # Last time step between calling 
+        self.profiler = None            # A profiler.TickProfiler timing drawing and flipping
+        self.draw_profile = False       # Overlay its percentiles?
     
         #Setup console
         self.console = pyconsole.Console(self.screen,pygame.Rect(0,0,self.resolution[0],self.resolution[1]/2))
@@ -32,143 +38,155 @@ class World:
                 self.console.process_input()
                 self.console.draw()
             if self.draw_frame_time:
-                srf = self.font.render("dt: " + str(round(dt*1000.)) + "ms", True, (255-self.background[0],255-self.background[1],255-self.background[2]))
+                srf = text_cache.render(self.font, "dt: " + str(round(timestep*1000.)) + "ms", (255-self.background[0],255-self.background[1],255-self.background[2]))
                 self.screen.blit(srf,(0,0))
+            if self.profiler != None:
+                if self.draw_profile: self.profiler.draw(self.screen, self.font, 0, self.font.get_height())
+                t = self.profiler.clock()
             pygame.display.flip()
             self.screen.fill(self.background)
+            if self.profiler != None: self.profiler.since('flip', t)
     
     def activate_console(self, activate):
         self.console.active = activate
         
 #Helper functions
 def text_blit_scale(surface, font, text, color, tx, ty, scale = 1.0, centerx = True, centery = True, background = None):
-    if background == None: srf = font.render(text, True, color)
-    else: srf = font.render(text, True, color, background)
-    #if scale <> 1.0:
-#        if background == None: srf = pygame.transform.smoothscale(srf,(srf.get_width()*scale,srf.get_height()*scale))
-#        else: srf = pygame.transform.scale(srf,int((srf.get_width()*scale),int(srf.get_height()*scale)))
+    srf = text_cache.render(font, text, color, 1.0, background)        #Rendered once, scaling stays off here
     if centerx: tx -= srf.get_width() / 2
     if centery: ty -= srf.get_height() / 2
     surface.blit(srf, (tx,ty))
 
+class NetworkView(object):
+    #Picture of a network on a surface of its own. The layout (unit centers, the end points of every weight's
+    #line) is computed once per topology. The weights, color mapped from blue (negative) to red (positive),
+    #the units and the names are a layer that is redrawn only when the parameters changed. The activations
+    #on top are refreshed at most every `interval` seconds, in between draw() returns the last picture.
+    #Weights into LSTM gates end at the unit the gate belongs to.
+    def __init__(self, network, font, size = (400, 300), text_scale = 1.0, interval = 0.2, weight_labels = False):
+        self.network = network
+        self.font = font
+        self.size = size
+        self.text_scale = text_scale
+        self.interval = interval
+        self.weight_labels = weight_labels          #Every weight's value on its line, readable for small networks only
+        self.surface = pygame.Surface(size, 0, 32)
+        self.layer = pygame.Surface(size, 0, 32)
+        self.topology = None
+        self.weights = None                         #Parameters the layer was drawn with
+        self.last = None                            #Time of the last refresh in ms
+        self.colors = [pygame.Color(40+int(215*max(v, 0.)), 40, 40+int(215*max(-v, 0.)))      #Small weights fade out
+                       for v in numpy.linspace(-1., 1., 256)]
+
+    def _topology(self):
+        n = self.network
+        return tuple((m.name, m.dim) for m in n.modulesSorted), n.paramdim
+    def _matrices(self):
+        #Fetched anew every time, learning replaces the params array the views are on
+        return [view for c, view in connection_views(self.network) if view.ndim == 2]
+    def _layout(self):
+        n = self.network
+        width, height = self.size
+        max_units = max(m.dim for m in n.modulesSorted)
+        slice_w = width / (max_units+1)
+        slice_h = height / len(n.modulesSorted)
+        self.radius = max(int(min(slice_w, slice_h)/4), 2)
+        self.number_scale = self.radius/2. / (self.font.get_height()*self.text_scale)
+        self.centers = {}                           #module -> (x array, y)
+        for i, m in enumerate(n.modulesSorted):
+            step = (width-slice_w) / float(m.dim)
+            self.centers[m] = ((slice_w + step*numpy.arange(m.dim) + step/2).astype(int), int(height - slice_h/2 - slice_h*i))
+        ends = []
+        for c, view in connection_views(n):
+            if view.ndim != 2: continue
+            unit_in, unit_out = [u.ravel() for u in numpy.indices(view.shape)]
+            unit_out %= c.outmod.dim
+            (xi, yi), (xo, yo) = self.centers[c.inmod], self.centers[c.outmod]
+            ends.append(numpy.column_stack((xi[unit_in], numpy.repeat(yi, len(unit_in)), xo[unit_out], numpy.repeat(yo, len(unit_in)))))
+        self.lines = [tuple(map(int, row)) for row in numpy.concatenate(ends)] if ends else []
+        self.topology = self._topology()
+        self.weights = None
+
+    def _params(self):
+        matrices = self._matrices()
+        if not matrices: return numpy.zeros(0)
+        return numpy.concatenate([w.ravel() for w in matrices])         #In the order of the lines
+    def _drawLayer(self, params):
+        layer = self.layer
+        layer.fill((0, 0, 0))
+        scale = max(abs(params).max(), 1e-9) if len(params) else 1.
+        shades = ((params / scale + 1.) * 127.5).astype(int)
+        colors = self.colors
+        draw_line = pygame.draw.line
+        for (x1, y1, x2, y2), shade in zip(self.lines, shades): draw_line(layer, colors[shade], (x1, y1), (x2, y2), 1)
+        white = pygame.Color(255,255,255)
+        black = pygame.Color(0,0,0)
+        if self.weight_labels:
+            for (x1, y1, x2, y2), value in zip(self.lines, params): self._label(layer, format_number(value), (x1+x2)/2, (y1+y2)/2)
+        for m in self.network.modulesSorted:
+            xs, y = self.centers[m]
+            text_blit_scale(layer, self.font, m.name, white, 0, y, self.text_scale, False, True)
+            for x in xs:
+                pygame.draw.circle(layer, black, (x, y), self.radius)
+                pygame.draw.circle(layer, white, (x, y), self.radius, min(3, self.radius))
+        self.weights = params.copy()
+
+    def buffers(self, m, activations):
+        #The module's latest input and output from activation_views, zeros where a module has none, e.g. the
+        #input of a bias unit
+        values = []
+        for row in activations[m.name]:
+            v = numpy.zeros(m.dim)
+            v[:min(m.dim, len(row))] = row[:m.dim]
+            values.append(v)
+        return values
+
+    def draw(self, force = False):
+        now = pygame.time.get_ticks()
+        if not force and self.last != None and now - self.last < self.interval*1000.: return self.surface
+        self.last = now
+        if self.topology != self._topology(): self._layout()
+        params = self._params()
+        if self.weights is None or not numpy.array_equal(params, self.weights): self._drawLayer(params)
+        srf = self.surface
+        srf.blit(self.layer, (0, 0))
+        activations = activation_views(self.network)
+        for m in self.network.modulesSorted:
+            xs, y = self.centers[m]
+            inb, outb = self.buffers(m, activations)
+            for x, i, o in zip(xs, inb, outb):
+                self._label(srf, format_number(o), x, y-self.radius*0.5)
+                self._label(srf, format_number(i), x, y+self.radius*0.5)
+        return srf
+    def _label(self, surface, text, x, y):
+        #Numbers shrink with the units, unlike the HUD's text_blit_scale
+        srf = text_cache.render(self.font, text, (255,255,255), self.text_scale*self.number_scale, (0,0,0))
+        surface.blit(srf, (x - srf.get_width()/2, y - srf.get_height()/2))
+
+    def layerList(self):
+        #What draw_network used to return: per module, per unit its center and buffers
+        layers = []
+        activations = activation_views(self.network)
+        for m in self.network.modulesSorted:
+            xs, y = self.centers[m]
+            inb, outb = self.buffers(m, activations)
+            layers.append([{'cx': x, 'cy': y, 'inputb': i, 'outputb': o} for x, i, o in zip(xs, inb, outb)])
+        return layers
+
+_network_views = weakref.WeakKeyDictionary()
 def draw_network(network, surface, font, text_scale = 1.0):
-    
-    #extract layer-data
-    layer_list = [[]]
-    names = []
-    i = 0
-    max_units = 0
-    for l in network.modulesSorted:
-        unit_descr = {}
-        unit = 0
-        while unit < l.dim:
-            if l.inputbuffer.size > unit:
-                unit_descr['inputb'] = l.inputbuffer[0][unit]
-            else: unit_descr['inputb'] = 0.0
-            
-            if l.outputbuffer.size > unit:
-                unit_descr['outputb'] = l.outputbuffer[0][unit]
-            else: unit_descr['outputb'] = 0.0
-            
-            layer_list[i].append(unit_descr.copy())
-            unit += 1
-        
-        max_units = max(max_units, l.dim)
-        i += 1
-        names.append(l.name)
-        layer_list.append([])
-        
-    layer_list.pop()
-    
-    #Partition the space for drawing
-    width = surface.get_width()
-    height = surface.get_height()
-    
-    slice_w = width / (max_units+1)
-    slice_h = height / len(layer_list)
-    radius = min(slice_w, slice_h)/4
-    
-    color = pygame.Color(255,255,255)
-    back_color = pygame.Color(0,0,0)
-    number_scale = radius/2 / (font.get_height()*text_scale)
-    
-    #Calculate centers
-    i = 0
-    for l in layer_list:
-        cy = height - (slice_h / 2) - slice_h*i
-        text_blit_scale(surface, font, names[i], color, 0, cy, text_scale, False, True)
-        for x in range(len(l)):
-            cx = slice_w + (width-slice_w)/len(l)*x + (width-slice_w)/len(l)/2
-            #Save center of circles
-            l[x]['cx'] = cx
-            l[x]['cy'] = cy          
-        i += 1
-
-    #Draw everything
-    i = 0
-    for l in layer_list:
-        for connection in network.connections.get(network.modulesSorted[i]):
-            if connection.__class__.__name__ == "FullConnection":
-                in_index  = network.modulesSorted.index(connection.inmod)
-                out_index = network.modulesSorted.index(connection.outmod)
-                for weight in range(len(connection.params)):
-                    #print i, in_index, out_index, weight, connection.whichBuffers(weight)
-                    unit_in, unit_out = connection.whichBuffers(weight)
-                    lx1, ly1 = layer_list[in_index][unit_in]['cx'],layer_list[in_index][unit_in]['cy']
-                    lx2, ly2 = layer_list[out_index][unit_out]['cx'],layer_list[out_index][unit_out]['cy']
-
-                    pygame.draw.line(surface, color, (lx1,ly1), (lx2,ly2), 3)
-                    text_blit_scale(surface, font, str(round(connection.params[weight],2)), color, (lx1+lx2)/2, (ly1+ly2)/2, text_scale*number_scale, True, True, back_color)
-         
-        for x in range(len(l)):
-            cx = l[x]['cx']
-            cy = l[x]['cy']
-            pygame.draw.circle(surface, color, (cx, cy), radius, 3)
-            text_blit_scale(surface, font, str(round(l[x]['outputb'],2)), color, cx, cy-radius*0.5, text_scale*number_scale, True, True, back_color)
-            text_blit_scale(surface, font, str(round(l[x]['inputb'],2)) , color, cx, cy+radius*0.5, text_scale*number_scale, True, True, back_color)
-        
-        i += 1
-    return layer_list
+    #Draws the whole network with the values of every weight onto surface, the layout is kept per network
+    view = _network_views.get(network)
+    if view == None or view.size != surface.get_size() or view.font != font or view.text_scale != text_scale:
+        view = _network_views[network] = NetworkView(network, font, surface.get_size(), text_scale, 0., True)
+    surface.blit(view.draw(True), (0, 0))
+    return view.layerList()
 
 def get_all_weights(network):
-
-    layer_list = [[]]
-    names = []
-    i = 0
-    max_units = 0
-    for l in network.modulesSorted:
-        unit_descr = {}
-        unit = 0
-        while unit < l.dim:
-            if l.inputbuffer.size > unit:
-                unit_descr['inputb'] = l.inputbuffer[0][unit]
-            else: unit_descr['inputb'] = 0.0
-            
-            if l.outputbuffer.size > unit:
-                unit_descr['outputb'] = l.outputbuffer[0][unit]
-            else: unit_descr['outputb'] = 0.0
-            
-            layer_list[i].append(unit_descr.copy())
-            unit += 1
-        
-        max_units = max(max_units, l.dim)
-        i += 1
-        names.append(l.name)
-        layer_list.append([])
-        
-    layer_list.pop()
-    i = 0
-    weights = []
-    for l in layer_list:
-        for connection in network.connections.get(network.modulesSorted[i]):
-            if connection.__class__.__name__ == "FullConnection":
-                in_index  = network.modulesSorted.index(connection.inmod)
-                out_index = network.modulesSorted.index(connection.outmod)
-                for weight in range(len(connection.params)):
-                    #print i, in_index, out_index, weight, connection.whichBuffers(weight)
-                    unit_in, unit_out = connection.whichBuffers(weight)
-                    weights.append(connection.params[weight])
-    return weights
+    #Flat copy of the weights of all FullConnections, for named views without copies see fastnet.weight_views
+    matrices = [view.T.ravel() for c, view in connection_views(network) if view.ndim == 2]
+    if not matrices: return numpy.zeros(0)
+    return numpy.concatenate(matrices)
 
 #Main
 import code
@@ -180,94 +198,281 @@ from pybrain.tools.shortcuts import buildNetwork
 
 from pybrain.rl.learners import *
 from pybrain.rl.agents import LearningAgent
+from pybrain.structure.evolvables.maskedmodule import MaskedModule
 
 from random import *
 from scipy import *
 
 
 import pickle
-def save_net(brain, filename):
-    pickle.dump(brain, open(filename, "wb"))
+from checkpoint import save_checkpoint, load_checkpoint, is_checkpoint, CheckpointWriter
+def save_net(brain, filename, state = False):
+    save_checkpoint(brain, filename, state = state)
 def load_net(filename):
-    n = pickle.load(open(filename))
+    if is_checkpoint(filename): return load_checkpoint(filename)[0]
+    n = pickle.load(open(filename))                #Old pickled brains, see checkpoint.py for converting them
     n.offset = 0                                  #seems the offsets get corrupted --> repair, bug?
     for m in n.modulesSorted: m.offset = 0
     return n
 
 from cage import *
 from cage2 import *
+from fastnet import CompiledNetwork, param_layout, connection_views, weight_views, activation_views
+from scheduler import FixedStepScheduler
+from recorder import TrajectoryRecorder
+from seeding import seed_everything, randomize_net, seed_explorer, fixed_address_space
+from arena import TiledArena, ActiveRegion
 
 class Team(object):
-    def __init__(self, living, task, learner = ENAC()):
+    profiler = None                                                 #A profiler.TickProfiler timing brain, reward and learning
+    checkpoints = None                                              #A checkpoint.CheckpointWriter, updated after every Learn
+    recorder = None                                                 #A recorder.TrajectoryRecorder, fed every Interaction
+    def __init__(self, living, task, learner = ENAC(), rng = None):
         self.living = living
         self.task = task
         self.last_reward = 0
         self.agent = LearningAgent(self.living.brain, learner)
-        self.oldparams = self.living.brain.params
+        if rng != None: seed_explorer(learner, rng)                #Exploration noise from a stream of its own
+        self._initLearnStats()
+    def setLearning(self, learning):
+        #Without learning no derivatives are needed, so the compiled brain acts instead of pybrain
+        self.agent.learning = learning
+        if learning:
+            self.agent.module = self.living.brain
+            self.agent.reset()                                      #Learner history must match the pybrain buffers again
+        else:
+            self.agent.module = CompiledNetwork(self.living.brain)
+            self.agent.module.pullState()
+    def brainChanged(self, params = True, state = False):
+        #The pybrain brain was changed from outside (mutated, restored, reset). Without learning the compiled
+        #brain acts on copies of its params and state, which are taken again
+        if self.agent.learning: return
+        if params: self.agent.module.pullParams()
+        if state: self.agent.module.pullState()
     def Interaction(self):
+        if self.profiler != None: return self._profiledInteraction()
         self.agent.integrateObservation(self.task.getObservation())
         self.task.performAction(self.agent.getAction())
         self.last_reward = self.task.getReward()
         self.agent.giveReward(self.last_reward)
+        self.reward_sum += self.last_reward
+        return self._finishInteraction()
+    def _profiledInteraction(self):
+        prof = self.profiler
+        t = prof.clock()
+        self.agent.integrateObservation(self.task.getObservation())
+        action = self.agent.getAction()
+        t = prof.since('brain', t)
+        self.task.performAction(action)
+        self.last_reward = self.task.getReward()
+        t = prof.since('reward', t)
+        self.agent.giveReward(self.last_reward)
+        self.reward_sum += self.last_reward
+        return self._finishInteraction()
+    def _finishInteraction(self):
         
         finished = self.task.isFinished()
+        if self.recorder != None: self.recorder.recordTeam(self, finished)
         if finished:
             #print task.cumreward
             self.agent.newEpisode()
             self.task.reset()
         return self.last_reward, finished
     
+    def _initLearnStats(self):
+        #Buffers for the learning diagnostics, allocated once. Connections (and modules with parameters,
+        #e.g. LSTM peepholes) are segments of the brain's parameter vector, reduced with one reduceat
+        brain = self.living.brain
+        layout = [(c, offset, length) for c, offset, length in param_layout(brain) if length > 0]
+        self.param_names = [("%s>%s" % (c.inmod.name, c.outmod.name)) if hasattr(c, 'inmod') else c.name for c, _, _ in layout]
+        self._param_starts = numpy.array([offset for _, offset, _ in layout], dtype=int)
+        self.oldparams = numpy.array(brain.params, dtype=float)
+        self._delta = numpy.zeros(brain.paramdim)
+        learner = self.agent.learner
+        self._oldlearner = numpy.array(learner.network.params, dtype=float) if hasattr(learner, 'gd') else None
+        self._step = None if self._oldlearner is None else numpy.zeros(len(self._oldlearner))
+        self._laststep = None if self._oldlearner is None else numpy.zeros(len(self._oldlearner))
+        self.learn_stats = {'dif': 0., 'delta_l2': 0., 'delta_max': 0., 'param_delta': numpy.zeros(len(layout)),
+                            'grad_norm': 0., 'step_size': 0., 'alpha': 0., 'reward': 0.}
+        self.reward_sum = 0.                                        #Collected since the last Learn
+        
     def Learn(self, episodes = 1):    
+        #Returns the squared change of the brain's weights, more diagnostics are in learn_stats
+        if self.profiler != None: t = self.profiler.clock()
+        learner = self.agent.learner
+        if self._oldlearner is not None:
+            self._oldlearner[:] = learner.network.params
+            alpha = learner.gd.alpha                                #Before a possible decay in the step
         self.agent.learn(episodes)
         self.agent.reset()
-                        
-        newparams = self.living.brain.params.copy() #get_all_weights(eater.brain)[:]
-        dif = 0
-        j = 0
-        for i in newparams:
-            dif += (self.oldparams[j] - newparams[j])**2
-            j += 1
-        self.oldparams = newparams
+        
+        stats = self.learn_stats
+        delta = numpy.subtract(self.living.brain.params, self.oldparams, self._delta)
+        self.oldparams[:] = self.living.brain.params
+        numpy.multiply(delta, delta, delta)
+        stats['dif'] = dif = delta.sum()
+        stats['delta_l2'] = numpy.sqrt(dif)
+        stats['delta_max'] = numpy.sqrt(delta.max()) if len(delta) else 0.
+        if len(self._param_starts): numpy.sqrt(numpy.add.reduceat(delta, self._param_starts), stats['param_delta'])
+        
+        if self._oldlearner is not None:                            #ENAC's step on the brain and the exploration
+            step = numpy.subtract(learner.network.params, self._oldlearner, self._step)
+            stats['step_size'] = numpy.sqrt(numpy.dot(step, step))
+            stats['alpha'] = alpha
+            gd = learner.gd
+            if gd.rprop: stats['grad_norm'] = numpy.sqrt(numpy.dot(gd.lastgradient, gd.lastgradient))
+            else:                                                   #step = alpha*gradient + momentum*last step
+                self._laststep *= -gd.momentum
+                self._laststep += step
+                stats['grad_norm'] = numpy.sqrt(numpy.dot(self._laststep, self._laststep)) / alpha if alpha else 0.
+            self._laststep[:] = step
+        stats['reward'] = self.reward_sum
+        self.reward_sum = 0.
+        if self.checkpoints != None: self.checkpoints.update(self)
+        if self.profiler != None: self.profiler.since('learn', t)
         return dif
+
+def build_cage(surface, max_food = 80, batch_sensors = False, seed = None):
+    #The baseline scenario: borders, platforms, an eater and the blue ball
+    cage_env = CageEnvironment(surface, 9.81, 45, (0,2), batch_sensors, seed)
+    cage_env.space.damping = 0.15
+    
+    #construct borders and platforms
+    borders = StaticLines(cage_env, [(-20,10),(-20,-6),(0,-5),(20,-6),(20,10)] , 0.25, (0.7,0.0,0.))
+    platform = StaticLines(cage_env, [(-5,0),(-1,0),(-0.5,0.5)],0.1,(0,1.0,1.0))
+    platforml = StaticLines(cage_env, [(-18,-4),(-9,-4.5)],0.1,(0,1.0,0.0))
+    platformr = StaticLines(cage_env, [(+18,-4),(+9,-4.5)],0.1,(0,1.0,0.0))    
+    eater = Eater(cage_env)
+    ball_c = Ball(cage_env, (3, 0), color = (0.0,0.1,0.9), radius = 0.6)     #Not on top of the eater: chipmunk would part them by memory address
+    food_pool = FoodPool(cage_env, max_food)
+    cage_env.enableSpatialIndex(2.)
+    return cage_env, eater, ball_c, food_pool
+
+def build_arena(surface, tiles = 25, max_food = 2000, batch_sensors = False, seed = None, reach = 1):
+    #A world of tiles side by side with an eater in the middle, things away from every living sleep (see arena.py)
+    cage_env = CageEnvironment(surface, 9.81, 45, (0,2), batch_sensors, seed)
+    cage_env.space.damping = 0.15
+    arena = TiledArena(cage_env, tiles, rng = cage_env.random)
+    ActiveRegion(cage_env, arena, reach)
+    eater = Eater(cage_env, (0, arena.floorAt(0) + 2))
+    food_pool = FoodPool(cage_env, max_food)
+    cage_env.enableSpatialIndex(2.)
+    return cage_env, eater, arena, food_pool
+
+def feed_cage(food_pool, clearance = 0.5, tries = 4):
+    #Drop food somewhere above the ground unless the pool is exhausted, returns the count before.
+    #A spot closer than clearance to another thing is drawn again, up to tries times
+    count = food_pool.active
+    for _ in range(tries):
+        if food_pool.spawn((food_pool.env.random.random_sample()*40-20, 0), clearance) != None: break
+        if food_pool.active == food_pool.capacity: break
+    return count
+
+def build_eat_scenario(surface, streams = None, max_food = 80, batch_sensors = True):
+    #What the main loop runs, also rebuilt by replay.py: the cage, its eater with TaskEat and the collision visualizer.
+    #Rays are cast in one SensorBatch per step, per eater senses the same (seeded runs match step for step)
+    cage_env, eater, ball_c, food_pool = build_cage(surface, max_food, batch_sensors, streams.seed('env', 0) if streams else None)
+    task = TaskEat(cage_env, eater, food_pool)
+    CollisionVisualizer(ball_c.shape, cage_env, True, False, False, False)
+    return cage_env, eater, task
+def eat_episode_over(eater, episode_time):
+    return (eater.energy <= 0.) or episode_time > 30.
+def respawn_eater(cage_env, eater):
+    eater.respawn((cage_env.random.random_sample()*40-20,2))
+
+def check_fresh_restore(seed = 0, steps = 60, after = 60):
+    #Smoke check of CageSnapshot with fresh: the eat scenario restored into a new space twice from the same
+    #snapshot runs the same steps both times. Returns the largest difference of the eater's positions, which
+    #is float noise at most (each new space allocates its contacts elsewhere, see seeding.py)
+    from seeding import RandomStreams
+    cage_env, eater, task = build_eat_scenario(None, RandomStreams(seed))
+    for s in range(steps):
+        cage_env.processTimeStep(1./30)
+        eat_housekeeping(cage_env, task, s)
+    snap = cage_env.snapshot()
+    runs = []
+    for _ in range(2):
+        cage_env.restore(snap, True)
+        track = []
+        for s in range(after):
+            cage_env.processTimeStep(1./30)
+            eat_housekeeping(cage_env, task, steps + s)
+            track.append(tuple(eater.body.position))
+        runs.append(numpy.array(track))
+    return abs(runs[0] - runs[1]).max()
+
+def make_eat_cage(k = 0, streams = None):          #Headless (environment, task) pair, e.g. for VectorCageEnvironment
+    #With seeding.RandomStreams the k-th cage sees the same events as the main loop's cage with the same seed
+    cage_env, eater, _, food_pool = build_cage(None, seed = streams.seed('env', k) if streams else None)
+    return cage_env, TaskEat(cage_env, eater, food_pool)
+def eat_housekeeping(cage_env, task, steps):
+    if (steps%40 >= 40-1): feed_cage(task.food_pool)
         
 if __name__ == '__main__':
 
+    import sys
+    if '--seed' in sys.argv: fixed_address_space()  #Same seed, same run, see seeding.py
+    if '--check-restore' in sys.argv:               #Smoke check: fresh snapshot restores of the eat scenario agree
+        dif = check_fresh_restore()
+        print "fresh restore: max difference %g" % dif
+        sys.exit(0 if dif <= 1e-9 else 1)
+    headless = '--headless' in sys.argv             #No display at all: no World, no drawing, no frame limit
+    profiler = None
+    if '--profile' in sys.argv:                     #--profile [stages.csv|stages.jsonl], F9 shows the percentiles
+        from profiler import TickProfiler
+        i = sys.argv.index('--profile') + 1
+        profiler = TickProfiler(300, sys.argv[i] if i < len(sys.argv) and not sys.argv[i].startswith('--') else None)
+    speed = 1.                                      #--speed X simulates X seconds per second, --unlimited as fast as possible (F11)
+    if '--speed' in sys.argv: speed = float(sys.argv[sys.argv.index('--speed') + 1])
+    checkpoints = None                              #--checkpoints DIR: periodic and best-so-far brains in DIR
+    if '--checkpoints' in sys.argv: checkpoints = CheckpointWriter(sys.argv[sys.argv.index('--checkpoints') + 1])
+    record_dir = None                               #--record DIR: every step's observation, action, reward and body
+    if '--record' in sys.argv: record_dir = sys.argv[sys.argv.index('--record') + 1]
+    video = None                                    #--video frames|run.raw [--video-every N]: offscreen, also headless
+    if '--video' in sys.argv:
+        from video import VideoRecorder
+        every = int(sys.argv[sys.argv.index('--video-every') + 1]) if '--video-every' in sys.argv else 1
+        video = VideoRecorder(sys.argv[sys.argv.index('--video') + 1], every = every)
+    
     pl.ion()
-    pygame.init()
-
-    world = World((800,600), (0,0,0))
-    world.console.submit_input("import __main__ as main\n")
+    if not headless:
+        pygame.init()
+        world = World((800,600), (0,0,0))
+        world.console.submit_input("import __main__ as main\n")
+        screen = world.screen
+    else: screen = None
     
     looping = True
-    rendering = True
+    rendering = not headless
     steps = 0
-    clk = pygame.time.Clock()
     fps = 30
-    dt = 1./fps
+    dt = 1./fps                                     #The simulation always advances by dt, rendering runs at fps
     time = 0
+    scheduler = FixedStepScheduler(dt, fps, speed, headless or '--unlimited' in sys.argv)
     
-    cage_env = CageEnvironment(world.screen, 9.81, 45, (0,2))
-    cage_env.space.damping = 0.15
-    
-    #construct borders and platforms
-    borders = StaticLines(cage_env, [(-20,10),(-20,-6),(0,-5),(20,-6),(20,10)] , 0.25, (0.7,0.0,0.))
-    platform = StaticLines(cage_env, [(-5,0),(-1,0),(-0.5,0.5)],0.1,(0,1.0,1.0))
-    platforml = StaticLines(cage_env, [(-18,-4),(-9,-4.5)],0.1,(0,1.0,0.0))
-    platformr = StaticLines(cage_env, [(+18,-4),(+9,-4.5)],0.1,(0,1.0,0.0))    
-    eater = Eater(cage_env)
+    seed = None                                     #--seed N repeats a run: food, respawns, brain init, exploration
+    if '--seed' in sys.argv: seed = int(sys.argv[sys.argv.index('--seed') + 1])
+    streams = seed_everything(seed)                 #Without --seed one is drawn, and printed
+    print "seed: %i" % streams.root
+    loop_random = streams.stream('loop')
+    cage_env, eater, task = build_eat_scenario(screen, streams, batch_sensors = '--per-eater-sensors' not in sys.argv)
+    food_pool = task.food_pool
     
     eater.brain = load_net("Eat_first_attempt.p")
-    eater.brain.randomize()
+    randomize_net(eater.brain, streams.stream('brain'))
     eater.brain.forget = False
     #eater.brain._setParameters([random.random()*1.-0.5 for x in range(eater.brain.paramdim)])
 
-    task = TaskEat(cage_env, eater)    
     learner = ENAC()
-    team = Team(eater, task, learner)
+    team = Team(eater, task, learner, streams.stream('explore', 0))
+    cage_env.profiler = team.profiler = profiler
+    team.checkpoints = checkpoints
+    if record_dir != None: team.recorder = TrajectoryRecorder.forLiving(record_dir, eater, meta = {'scenario': 'eat', 'seed': streams.root, 'fps': fps})
+    if not headless: world.profiler = profiler
     
     ball = None
-    ball_c = Ball(cage_env, color = (0.0,0.1,0.9), radius = 0.6)
-    CollisionVisualizer(ball_c.shape, cage_env, True, False, False, False)  
+    snap = None
+    network_view = None                             #F12: live view of the brain, refreshed 5 times a second
     count_food = 0
     
     while looping:
@@ -280,82 +485,100 @@ if __name__ == '__main__':
         #if (steps%m_steps >= m_steps-1) or agent.history.getNumSequences() >= 2:
         #if task.isFinished() or time > 30. or eater.energy <= 0:
             dif = team.Learn()     
-            print steps+1, " -     " + "brain dif: %3.8f" %dif + "  - energy: %3.3f" %eater.energy
+            print steps+1, " -     " + "brain dif: %3.8f" %dif + "  - energy: %3.3f" %eater.energy + "  - step: %.2e  grad: %.2e" % (team.learn_stats['step_size'], team.learn_stats['grad_norm'])
             print "Food: ", count_food
         
-        if (eater.energy <= 0.) or time > 30.: 
-            eater.energy = 1.0
+        if eat_episode_over(eater, time): 
             print "---------------------------------------------------------------------- : tal: ", time
-            eater.body.position = random.random()*40-20,2
-            for s in eater.sensors: s._zero()          
+            respawn_eater(cage_env, eater)
+            if team.recorder != None: team.recorder.newEpisode()
             #agent.newEpisode()
             task.reset()
             time = 0
 
-        if (steps%m_steps >= m_steps-1) and random.random() > 0.6 or time > 30:
+        if (steps%m_steps >= m_steps-1) and loop_random.random_sample() > 0.6 or time > 30:
             #team.agent.learner.explorer.sigma = [100000000000]*len(team.agent.learner.explorer.sigma)
             team.agent.learner.network.reset()
             team.agent.reset()
+            team.brainChanged(False, True)
             #team.agent.newEpisode()               
 
         if (steps%40 >= 40-1):
-            count = 0
-            for thing in cage_env.things:
-                if isinstance(thing, Food): count += 1 
-            if count <= 80: Food(cage_env, (random.random()*40-20, 0))
-            count_food = count
+            count_food = feed_cage(food_pool)
             
-        text_blit_scale(world.screen, world.font, "%.1f" % reward, (255,255,255), 400,20, 1.5, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: energy" % eater.inbuf[0], (127,255,127), 400,40, 1, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: velo.x" % eater.inbuf[1], (127,255,127), 400,60, 1, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: accel" % eater.outbuf[0], (127,255,127), 400,80, 1, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: jump" % eater.outbuf[1], (127,255,127), 400,100, 1, False, True, (0,0,0))
+        frame = not headless and scheduler.frameDue()   #Everything on screen only once per rendered frame
+        cage_env.rendering = rendering and frame
+        if frame:
+            text_blit_scale(world.screen, world.font, "%.1f" % reward, (255,255,255), 400,20, 1.5, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: energy" % eater.inbuf[0], (127,255,127), 400,40, 1, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: velo.x" % eater.inbuf[1], (127,255,127), 400,60, 1, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: accel" % eater.outbuf[0], (127,255,127), 400,80, 1, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: jump" % eater.outbuf[1], (127,255,127), 400,100, 1, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%i ticks/frame" % scheduler.frame_substeps, (127,127,255), 400,120, 1, False, True, (0,0,0))
         
-        events = pygame.event.get()
-        for e in events:
-            if e.type==QUIT: looping = False
-            if e.type==KEYDOWN:
-                if e.key == K_ESCAPE: looping = False
-                if e.key == K_F1: world.activate_console(not world.console.active)
-                if e.key == K_F2: code.interact(local=locals())
-                #if e.key == K_F3:
-                if e.key == K_F4:
-                    pl.clf()
-                if e.key == K_LEFT: eater.acceleration = -1.
-                if e.key == K_RIGHT: eater.acceleration = 1.
-                if e.key == K_UP: eater.jump = True
-                if e.key == K_F5: 
-                    evo_n = MaskedModule(eater.brain)
-                    evo_n.mutate()
-                if e.key == K_F6:
-                    team.agent.learning = not team.agent.learning
-                    if team.agent.learning: pygame.draw.circle(world.screen, (255,255,0), (40, 40), 5)            
-                if e.key == K_F7: 
-                    eater.body.position = 2,3   
-                if e.key == K_F10: rendering = not rendering
-                pygame.draw.circle(world.screen, (255,0,0), (20, 40), 5)
-            if e.type==KEYUP:
-                if e.key == K_LEFT: eater.acceleration = 0.
-                if e.key == K_RIGHT: eater.acceleration = 0.
-                if e.key == K_UP: eater.jump = False               
-                pygame.draw.circle(world.screen, (0,255,0), (20, 20), 5)
-            if e.type==MOUSEBUTTONDOWN:
-                if e.button == 4: 
-                    cage_env.scale *= 1.05
-                if e.button == 5:
-                    cage_env.scale *= 1./1.05
-                x, y = (pygame.mouse.get_pos())
-                cage_env.offset_x -= (x-world.screen.get_width()/2)*0.25
-                cage_env.offset_y -= (y-world.screen.get_height()/2)*0.25                               
-            pygame.event.post(e)              
+            events = pygame.event.get()
+            for e in events:
+                if e.type==QUIT: looping = False
+                if e.type==KEYDOWN:
+                    if e.key == K_ESCAPE: looping = False
+                    if e.key == K_F1: world.activate_console(not world.console.active)
+                    if e.key == K_F2: code.interact(local=locals())
+                    if e.key == K_F3: snap = cage_env.snapshot()
+                    if e.key == K_F4:
+                        pl.clf()
+                    if e.key == K_LEFT: eater.acceleration = -1.
+                    if e.key == K_RIGHT: eater.acceleration = 1.
+                    if e.key == K_UP: eater.jump = True
+                    if e.key == K_F5: 
+                        evo_n = MaskedModule(eater.brain)
+                        evo_n.mutate()
+                        team.brainChanged()
+                    if e.key == K_F6:
+                        team.setLearning(not team.agent.learning)
+                        if team.agent.learning: pygame.draw.circle(world.screen, (255,255,0), (40, 40), 5)            
+                    if e.key == K_F7: 
+                        eater.body.position = 2,3   
+                    if e.key == K_F8 and snap != None:
+                        cage_env.restore(snap)
+                        team.brainChanged(False, True)
+                    if e.key == K_F9: world.draw_profile = not world.draw_profile
+                    if e.key == K_F10: rendering = not rendering
+                    if e.key == K_F11: scheduler.setUnlimited(not scheduler.unlimited)
+                    if e.key == K_F12: network_view = None if network_view != None else NetworkView(eater.brain, world.font, (400, 300))
+                    pygame.draw.circle(world.screen, (255,0,0), (20, 40), 5)
+                if e.type==KEYUP:
+                    if e.key == K_LEFT: eater.acceleration = 0.
+                    if e.key == K_RIGHT: eater.acceleration = 0.
+                    if e.key == K_UP: eater.jump = False               
+                    pygame.draw.circle(world.screen, (0,255,0), (20, 20), 5)
+                if e.type==MOUSEBUTTONDOWN:
+                    if e.button == 4: 
+                        cage_env.scale *= 1.05
+                    if e.button == 5:
+                        cage_env.scale *= 1./1.05
+                    x, y = (pygame.mouse.get_pos())
+                    cage_env.offset_x -= (x-world.screen.get_width()/2)*0.25
+                    cage_env.offset_y -= (y-world.screen.get_height()/2)*0.25                               
+                pygame.event.post(e)              
             
-        cage_env.processTimeStep(1./fps)            
-        if rendering: cage_env.drawThings()  
-        if rendering: world.tick(dt)
-        pygame.event.clear()
-        if rendering: dt = clk.tick(fps)/1000.
-        else: dt = 1./fps
+        cage_env.processTimeStep(dt)            
+        if video != None: video.tick(cage_env)
+        if frame:
+            scheduler.frameDone()
+            if rendering: cage_env.drawThings()  
+            if rendering and network_view != None:
+                w, h = network_view.size
+                world.screen.blit(network_view.draw(), (world.screen.get_width()-w, world.screen.get_height()-h))
+            if rendering: world.tick(scheduler.frame_time)
+            pygame.event.clear()
+        scheduler.tick()
         time += dt
         steps += 1
-
-
+        if profiler != None: profiler.tick()
+    
+    if checkpoints != None: checkpoints.close()     #Whatever is queued still gets written
+    if profiler != None: profiler.close()
+    if team.recorder != None: team.recorder.close()
+    if video != None:
+        video.close()
+        print "video: %i frames, %i dropped" % (video.written, video.dropped)
@@ -4,6 +4,7 @@ import pygame
 from pygame.locals import *
 
 import pyconsole
+from textcache import text_cache, format_number
 import pylab as pl
 
 
@@ -41,11 +42,7 @@ class World:
         
 #Helper functions
 def text_blit_scale(surface, font, text, color, tx, ty, scale = 1.0, centerx = True, centery = True, background = None):
-    if background == None: srf = font.render(text, True, color)
-    else: srf = font.render(text, True, color, background)
-    if scale <> 1.0:
-        if background == None: srf = pygame.transform.smoothscale(srf,(srf.get_width()*scale,srf.get_height()*scale))
-        else: srf = pygame.transform.scale(srf,(srf.get_width()*scale,srf.get_height()*scale))
+    srf = text_cache.render(font, text, color, scale, background)      #Rendered and scaled once
     if centerx: tx -= srf.get_width() / 2
     if centery: ty -= srf.get_height() / 2
     surface.blit(srf, (tx,ty))
@@ -117,14 +114,14 @@ def draw_network(network, surface, font, text_scale = 1.0):
                     lx2, ly2 = layer_list[out_index][unit_out]['cx'],layer_list[out_index][unit_out]['cy']
 
                     pygame.draw.line(surface, color, (lx1,ly1), (lx2,ly2), 3)
-                    text_blit_scale(surface, font, str(round(connection.params[weight],2)), color, (lx1+lx2)/2, (ly1+ly2)/2, text_scale*number_scale, True, True, back_color)
+                    text_blit_scale(surface, font, format_number(connection.params[weight]), color, (lx1+lx2)/2, (ly1+ly2)/2, text_scale*number_scale, True, True, back_color)
          
         for x in range(len(l)):
             cx = l[x]['cx']
             cy = l[x]['cy']
             pygame.draw.circle(surface, color, (cx, cy), radius, 3)
-            text_blit_scale(surface, font, str(round(l[x]['outputb'],2)), color, cx, cy-radius*0.5, text_scale*number_scale, True, True, back_color)
-            text_blit_scale(surface, font, str(round(l[x]['inputb'],2)) , color, cx, cy+radius*0.5, text_scale*number_scale, True, True, back_color)
+            text_blit_scale(surface, font, format_number(l[x]['outputb']), color, cx, cy-radius*0.5, text_scale*number_scale, True, True, back_color)
+            text_blit_scale(surface, font, format_number(l[x]['inputb']) , color, cx, cy+radius*0.5, text_scale*number_scale, True, True, back_color)
         
         i += 1
     return layer_list
@@ -231,21 +228,26 @@ class Team(object):
         
 if __name__ == '__main__':
 
+    import sys
+    headless = '--headless' in sys.argv             #No display at all: no World, no drawing, no frame limit
+    
     pl.ion()
-    pygame.init()
-
-    world = World((800,600), (0,0,0))
-    world.console.submit_input("import __main__ as main\n")
+    if not headless:
+        pygame.init()
+        world = World((800,600), (0,0,0))
+        world.console.submit_input("import __main__ as main\n")
+        screen = world.screen
+    else: screen = None
     
     looping = True
-    rendering = True
+    rendering = not headless
     steps = 0
     clk = pygame.time.Clock()
     fps = 30
     dt = 1./fps
     time = 0
     
-    cage_env = CageEnvironment(world.screen, 9.81, 45, (0,2))
+    cage_env = CageEnvironment(screen, 9.81, 45, (0,2))
     cage_env.space.damping = 0.15
     
     #construct borders and platforms
@@ -304,54 +306,57 @@ if __name__ == '__main__':
             if count <= 80: Food(cage_env, (random.random()*40-20, 0))
             count_food = count
             
-        text_blit_scale(world.screen, world.font, "%.1f" % reward, (255,255,255), 400,20, 1.5, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: energy" % eater.inbuf[0], (127,255,127), 400,40, 1, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: velo.x" % eater.inbuf[1], (127,255,127), 400,60, 1, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: accel" % eater.outbuf[0], (127,255,127), 400,80, 1, False, True, (0,0,0))
-        text_blit_scale(world.screen, world.font, "%.2f: jump" % eater.outbuf[1], (127,255,127), 400,100, 1, False, True, (0,0,0))
+        if not headless:
+            text_blit_scale(world.screen, world.font, "%.1f" % reward, (255,255,255), 400,20, 1.5, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: energy" % eater.inbuf[0], (127,255,127), 400,40, 1, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: velo.x" % eater.inbuf[1], (127,255,127), 400,60, 1, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: accel" % eater.outbuf[0], (127,255,127), 400,80, 1, False, True, (0,0,0))
+            text_blit_scale(world.screen, world.font, "%.2f: jump" % eater.outbuf[1], (127,255,127), 400,100, 1, False, True, (0,0,0))
         
-        events = pygame.event.get()
-        for e in events:
-            if e.type==QUIT: looping = False
-            if e.type==KEYDOWN:
-                if e.key == K_ESCAPE: looping = False
-                if e.key == K_F1: world.activate_console(not world.console.active)
-                if e.key == K_F2: code.interact(local=locals())
-                #if e.key == K_F3:
-                if e.key == K_F4:
-                    pl.clf()
-                if e.key == K_LEFT: eater.acceleration = -1.
-                if e.key == K_RIGHT: eater.acceleration = 1.
-                if e.key == K_UP: eater.jump = True
-                if e.key == K_F5: 
-                    evo_n = MaskedModule(eater.brain)
-                    evo_n.mutate()
-                if e.key == K_F6:
-                    team.agent.learning = not team.agent.learning
-                    if team.agent.learning: pygame.draw.circle(world.screen, (255,255,0), (40, 40), 5)            
-                if e.key == K_F7: 
-                    eater.body.position = 2,3   
-                if e.key == K_F10: rendering = not rendering
-                pygame.draw.circle(world.screen, (255,0,0), (20, 40), 5)
-            if e.type==KEYUP:
-                if e.key == K_LEFT: eater.acceleration = 0.
-                if e.key == K_RIGHT: eater.acceleration = 0.
-                if e.key == K_UP: eater.jump = False               
-                pygame.draw.circle(world.screen, (0,255,0), (20, 20), 5)
-            if e.type==MOUSEBUTTONDOWN:
-                if e.button == 4: 
-                    cage_env.scale *= 1.05
-                if e.button == 5:
-                    cage_env.scale *= 1./1.05
-                x, y = (pygame.mouse.get_pos())
-                cage_env.offset_x -= (x-world.screen.get_width()/2)*0.25
-                cage_env.offset_y -= (y-world.screen.get_height()/2)*0.25                               
-            pygame.event.post(e)              
+            events = pygame.event.get()
+            for e in events:
+                if e.type==QUIT: looping = False
+                if e.type==KEYDOWN:
+                    if e.key == K_ESCAPE: looping = False
+                    if e.key == K_F1: world.activate_console(not world.console.active)
+                    if e.key == K_F2: code.interact(local=locals())
+                    #if e.key == K_F3:
+                    if e.key == K_F4:
+                        pl.clf()
+                    if e.key == K_LEFT: eater.acceleration = -1.
+                    if e.key == K_RIGHT: eater.acceleration = 1.
+                    if e.key == K_UP: eater.jump = True
+                    if e.key == K_F5: 
+                        evo_n = MaskedModule(eater.brain)
+                        evo_n.mutate()
+                    if e.key == K_F6:
+                        team.agent.learning = not team.agent.learning
+                        if team.agent.learning: pygame.draw.circle(world.screen, (255,255,0), (40, 40), 5)            
+                    if e.key == K_F7: 
+                        eater.body.position = 2,3   
+                    if e.key == K_F10: 
+                        rendering = not rendering
+                        cage_env.rendering = rendering
+                    pygame.draw.circle(world.screen, (255,0,0), (20, 40), 5)
+                if e.type==KEYUP:
+                    if e.key == K_LEFT: eater.acceleration = 0.
+                    if e.key == K_RIGHT: eater.acceleration = 0.
+                    if e.key == K_UP: eater.jump = False               
+                    pygame.draw.circle(world.screen, (0,255,0), (20, 20), 5)
+                if e.type==MOUSEBUTTONDOWN:
+                    if e.button == 4: 
+                        cage_env.scale *= 1.05
+                    if e.button == 5:
+                        cage_env.scale *= 1./1.05
+                    x, y = (pygame.mouse.get_pos())
+                    cage_env.offset_x -= (x-world.screen.get_width()/2)*0.25
+                    cage_env.offset_y -= (y-world.screen.get_height()/2)*0.25                               
+                pygame.event.post(e)              
             
         cage_env.processTimeStep(1./fps)            
         if rendering: cage_env.drawThings()  
         if rendering: world.tick(dt)
-        pygame.event.clear()
+        if not headless: pygame.event.clear()
         if rendering: dt = clk.tick(fps)/1000.
         else: dt = 1./fps
         time += dt
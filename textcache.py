@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+import pygame
+
+__author__ = 'AH'
+
+#Rendered (and scaled) text surfaces, least recently used ones are dropped beyond `capacity`. HUD lines and
+#the numbers of the network view change only in their last digit, if at all: formatted with format_number
+#most of them are hits.
+
+class TextCache(object):
+    def __init__(self, capacity = 1024):
+        self.capacity = capacity
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color, scale = 1.0, background = None):
+        key = (font, text, tuple(color), round(scale, 3), None if background == None else tuple(background))
+        srf = self.surfaces.pop(key, None)
+        if srf != None:
+            self.hits += 1
+            self.surfaces[key] = srf                    #Most recently used again
+            return srf
+        self.misses += 1
+        if background == None: srf = font.render(text, True, color)
+        else: srf = font.render(text, True, color, background)
+        if scale <> 1.0:
+            size = (max(int(srf.get_width()*scale), 1), max(int(srf.get_height()*scale), 1))
+            if background == None: srf = pygame.transform.smoothscale(srf, size)
+            else: srf = pygame.transform.scale(srf, size)
+        self.surfaces[key] = srf
+        if len(self.surfaces) > self.capacity: self.surfaces.popitem(False)
+        return srf
+
+    def clear(self):
+        self.surfaces.clear()
+
+def format_number(value, digits = 2):
+    #Fixed decimals, -0.00 is 0.00
+    text = "%.*f" % (digits, value)
+    if text.startswith('-') and not text.strip('-0.'): text = text[1:]
+    return text
+
+text_cache = TextCache()
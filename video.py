@@ -0,0 +1,112 @@
+import json
+import os
+import Queue
+import struct
+import threading
+import zlib
+
+import numpy
+import pygame
+
+__author__ = 'AH'
+
+#Video of a CageEnvironment without a display. Every `every`th tick the things are drawn into an offscreen
+#surface, which is handed as it is to a writer thread; the thread reads its pixels through a buffer view
+#and puts the surface back into the pool. With all `pool` surfaces queued a frame is dropped before it is
+#drawn, so a slow disk never slows the simulation down.
+#A path ending with .raw gets raw bgr0 frames (with a .json describing them), anything else is a directory
+#of PNGs. Both are encoded with zlib and plain file writes, which let go of the GIL, pygame's savers do not.
+#
+#   ffmpeg -f rawvideo -pix_fmt bgr0 -s 800x600 -r 30 -i run.raw run.mp4
+#   ffmpeg -r 30 -i frames/frame%06d.png run.mp4
+
+MASKS = (0xff0000, 0xff00, 0xff, 0)                     #bgr0 in memory on little endian machines
+
+def png_bytes(rgb, level = 1):
+    #(height, width, 3) uint8 as PNG, rows unfiltered
+    h, w = rgb.shape[:2]
+    rows = numpy.zeros((h, 1 + w*3), numpy.uint8)      #Filter byte 0 in front of every row
+    rows[:, 1:].reshape(h, w, 3)[:] = rgb
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return ('\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows.tostring(), level)) + chunk('IEND', ''))
+
+class VideoRecorder(object):
+    def __init__(self, path, size = (800, 600), every = 1, xdim = 45., focus = (0., 2.), pool = 4, fps = 30, png_level = 1):
+        self.path = path
+        self.size = size
+        self.every = every
+        self.xdim, self.focus = xdim, focus             #The view, like CageEnvironment.setSurface
+        self.png_level = png_level
+        self.raw = path.endswith('.raw')
+        self.ticks = 0
+        self.frames = 0                                 #Captured
+        self.dropped = 0
+        self.written = 0
+        if self.raw:
+            self.stream = open(path, 'wb')
+            f = open(path + '.json', 'w')
+            json.dump({'width': size[0], 'height': size[1], 'pix_fmt': 'bgr0', 'fps': float(fps) / every}, f)
+            f.close()
+        elif not os.path.isdir(path): os.makedirs(path)
+        self.free = Queue.Queue()
+        for _ in range(pool): self.free.put(pygame.Surface(size, 0, 32, MASKS))
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tick(self, env):
+        #Once per simulated step
+        due = self.ticks % self.every == 0
+        self.ticks += 1
+        if due: return self.capture(env)
+        return False
+
+    def capture(self, env):
+        try: surface = self.free.get_nowait()
+        except Queue.Empty:
+            self.dropped += 1
+            return False
+        profiler = env.profiler                                     #Capture is its own stage, not part of 'draw'
+        if profiler != None: t = profiler.clock()
+        surface.fill((0, 0, 0))
+        view = env.surface, env.rendering, env.scale, env.offset_x, env.offset_y, profiler
+        env.setSurface(surface, self.xdim, self.focus)
+        env.profiler = None
+        env.drawThings()
+        env.surface, env.rendering, env.scale, env.offset_x, env.offset_y, env.profiler = view
+        if profiler != None: profiler.since('video', t)
+        self.queue.put((self.frames, surface))
+        self.frames += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item == None: break
+            index, surface = item
+            try: self._write(index, surface)
+            finally: self.free.put(surface)
+    def _write(self, index, surface):
+        pixels = numpy.asarray(surface.get_view('2')).T    #(height, width) uint32, no copy
+        if self.raw:
+            pixels.tofile(self.stream)
+        else:
+            bgrx = pixels.view(numpy.uint8).reshape(pixels.shape + (4,))
+            data = png_bytes(bgrx[:, :, 2::-1], self.png_level)
+            name = os.path.join(self.path, 'frame%06i.png' % index)
+            f = open(name + '.tmp', 'wb')
+            f.write(data)
+            f.close()
+            os.rename(name + '.tmp', name)
+        self.written += 1                               #The views die here, which unlocks the surface for the pool
+
+    def close(self):
+        #Writes what is queued
+        if self.thread == None: return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.raw: self.stream.close()